@@ -10,7 +10,7 @@ from habrasanta.models import Event, Participation, Season, User
 
 
 class SeasonAdmin(admin.ModelAdmin):
-    readonly_fields = ["address_match"]
+    readonly_fields = ["address_match", "match_seed"]
 
 
 class ParticipationInline(admin.StackedInline):
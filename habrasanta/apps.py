@@ -1,5 +1,6 @@
 from django.apps import AppConfig
 from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.models.signals import post_delete, post_save
 
 
 class HabrasantaConfig(AppConfig):
@@ -8,5 +9,8 @@ class HabrasantaConfig(AppConfig):
 
     def ready(self):
         from habrasanta import signals
+        from habrasanta.models import Season
         user_logged_in.connect(signals.log_user_login)
         user_logged_out.connect(signals.log_user_logout)
+        post_save.connect(signals.invalidate_season_cache, sender=Season)
+        post_delete.connect(signals.invalidate_season_cache, sender=Season)
@@ -2,7 +2,7 @@ from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 
 from habrasanta.models import User
-from habrasanta.utils import fetch_habr_profile, session
+from habrasanta.utils import HabrIsDownException, fetch_habr_profile, session
 
 
 class PublicHabrBackend(ModelBackend):
@@ -12,17 +12,21 @@ class PublicHabrBackend(ModelBackend):
     This backend authenticates users using the Habr's semi-public API.
     """
     def authenticate(self, request, authorization_code=None):
-        response = session.post(settings.HABR_TOKEN_URL, data={
-            "grant_type": "authorization_code",
-            "code": authorization_code,
-            "client_id": settings.HABR_CLIENT_ID,
-            "client_secret": settings.HABR_CLIENT_SECRET,
-        })
-        if response.status_code != 200:
+        try:
+            response = session.post(settings.HABR_TOKEN_URL, data={
+                "grant_type": "authorization_code",
+                "code": authorization_code,
+                "client_id": settings.HABR_CLIENT_ID,
+                "client_secret": settings.HABR_CLIENT_SECRET,
+            })
+            if response.status_code != 200:
+                return None
+            data = response.json()
+            access_token = data.get("access_token")
+            profile = self.fetch_profile(access_token)
+        except HabrIsDownException:
+            # The circuit breaker is open, don't keep the user waiting.
             return None
-        data = response.json()
-        access_token = data.get("access_token")
-        profile = self.fetch_profile(access_token)
         if not profile:
             return None
         habr_id = profile.get("id")
@@ -67,7 +71,10 @@ class FakeBackend(ModelBackend):
             return None
         # Username is passed instead of the real authorization code.
         username = authorization_code
-        profile = fetch_habr_profile(username)
+        try:
+            profile = fetch_habr_profile(username)
+        except HabrIsDownException:
+            return None
         if not profile:
             return None
         try:
@@ -1,8 +1,11 @@
 import logging
 import os
+import time
 
 from celery import Celery
 from celery.exceptions import Reject
+from celery.signals import task_postrun
+from datetime import timedelta
 from django.conf import settings
 from django.core.mail import EmailMessage
 
@@ -15,8 +18,15 @@ app = Celery("habrasanta")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
 
-@app.task
-def send_notification(user_id, message):
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # Workers may stay idle for hours, don't keep the numbers in memory.
+    from habrasanta import metrics
+    metrics.flush()
+
+
+@app.task(bind=True)
+def send_notification(self, user_id, message):
     from habrasanta.models import User
     from habrasanta.utils import session
     user = User.objects.get(pk=user_id)
@@ -115,3 +125,117 @@ def give_badge(self, user_id):
     except Exception as e:
         # Happens when connection was successful, but Habr is boom-boom.
         raise self.retry(countdown=60 * 5, exc=e)
+
+
+@app.task
+def warm_up_profiles():
+    """
+    Fetches Habr profiles of likely participants shortly before the registration opens,
+    so the rush of the first minutes doesn't hit Habr with cold caches.
+
+    Runs never overlap, otherwise they would fetch the same users and exceed the rate.
+    """
+    from django.core.cache import cache
+    from django.utils import timezone
+    from habrasanta.models import Season
+    now = timezone.now()
+    season = Season.objects.filter(
+        registration_open__gt=now,
+        registration_open__lte=now + timedelta(seconds=settings.HABR_WARMUP_LEAD_TIME),
+    ).first()
+    if not season:
+        return None
+    # Expires a bit later than the run is allowed to take, in case the worker is killed.
+    if not cache.add("warm-up-profiles", True, settings.HABR_WARMUP_INTERVAL + 60):
+        logger.warning("The previous warm-up is still running, skipped")
+        return None
+    try:
+        return warm_up_season(season, now)
+    finally:
+        cache.delete("warm-up-profiles")
+
+
+def warm_up_season(season, now):
+    """
+    Warms up as many profiles as fit into one run of warm_up_profiles.
+    """
+    from django.db.models import Q
+    from habrasanta.models import Participation, User
+    from habrasanta.utils import HabrIsDownException, refresh_habr_profile
+    window_start = now - timedelta(seconds=settings.HABR_WARMUP_LEAD_TIME)
+    users = User.objects.filter(
+        Q(last_online__gte=now - timedelta(days=settings.HABR_WARMUP_ACTIVE_DAYS)) |
+        Q(id__in=Participation.objects.exclude(season=season).values("user_id")),
+        is_banned=False,
+    ).filter(
+        # Profiles refreshed during the previous runs stay fresh until after the opening.
+        Q(profile_fetched_at=None) | Q(profile_fetched_at__lt=window_start),
+    ).order_by("-last_online")
+    start = time.monotonic()
+    warmed = 0
+    failed = 0
+    for user in users.iterator():
+        # Finish before the next run is due, so it isn't skipped.
+        if time.monotonic() - start > settings.HABR_WARMUP_INTERVAL - 30:
+            logger.info("Ran out of time, the rest is left for the next run")
+            break
+        try:
+            user.remember_profile(refresh_habr_profile(user.login))
+        except HabrIsDownException:
+            logger.warning("Habr is down, stopped warming up profiles")
+            break
+        except Exception as e:
+            logger.warning("Could not warm up the profile of '{}': {}".format(user.login, e))
+            failed += 1
+        else:
+            warmed += 1
+        # Stay within the Habr API limits, a profile costs up to two requests (card and whois).
+        time.sleep(2 / settings.HABR_WARMUP_RATE)
+    elapsed = time.monotonic() - start
+    logger.info("Warmed up {} profiles in {:.1f} s before season {} ({} failed)".format(
+        warmed, elapsed, season.id, failed))
+    return {
+        "season": season.id,
+        "warmed": warmed,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+    }
+
+
+@app.task
+def rebuild_country_stats():
+    """
+    Rebuilds the country stats of all active seasons to correct any drift, e.g. after
+    participations were deleted from the admin panel or Redis was unavailable for a while.
+    """
+    from django.utils import timezone
+    from habrasanta.models import Season
+    seasons = Season.objects.filter(season_close__gt=timezone.now())
+    for season in seasons:
+        season.rebuild_country_stats()
+    return [season.id for season in seasons]
+
+
+@app.task
+def rebuild_unread_counters():
+    """
+    Rebuilds the unread counters of all participants of active seasons to correct any drift.
+    """
+    from django.utils import timezone
+    from habrasanta.chat import rebuild_unread
+    from habrasanta.models import Participation
+    return len(rebuild_unread(Participation.objects.filter(season__season_close__gt=timezone.now())))
+
+
+@app.task
+def send_chat_notifications():
+    """
+    Sends the notifications about new messages whose debounce is over.
+    """
+    from django.db import transaction
+    from habrasanta.chat import notify_unread, pop_due_notifications
+    user_ids = pop_due_notifications()
+    if not user_ids:
+        return 0
+    with transaction.atomic():
+        return notify_unread(user_ids)
@@ -0,0 +1,389 @@
+"""
+Real-time delivery of chat messages and unread counters.
+
+Every participation has its own Redis channel. New messages are published there once
+the transaction is committed, and the open tabs of the recipient are listening via
+server-sent events (see views.chat_stream, served by habrasanta.asgi).
+
+Unread counters are kept in a Redis hash per participation, with a field per chat.
+
+Notifications about new messages are debounced: the recipient is put into a Redis sorted
+set scored by the time the notification is due, and a beat task sends out the due ones.
+"""
+import asyncio
+import json
+import logging
+import redis
+import redis.asyncio
+import time
+import weakref
+
+from celery import group
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+from functools import partial
+from rest_framework.utils.encoders import JSONEncoder
+
+from habrasanta.utils import hincrby_if_exists, redis_client, russian_plural
+
+
+logger = logging.getLogger(__name__)
+
+UNREAD_CHATS = ["santa_chat", "giftee_chat"]
+# Counters of archived seasons are not rebuilt anymore, so let them go eventually.
+UNREAD_TTL = 60 * 60 * 24 * 90
+# read_date was introduced on this day, all messages before must stay NULL.
+READ_DATE_INTRODUCED = datetime(2016, 12, 20, tzinfo=timezone.utc)
+NOTIFICATIONS_KEY = "chat-notifications"
+
+
+def channel_name(participation_id):
+    return "chat:{}".format(participation_id)
+
+
+def recipient_chat(message):
+    """
+    Returns the chat on the recipient's side, santa_chat or giftee_chat.
+    """
+    return "santa_chat" if message.sender.giftee_id == message.recipient_id else "giftee_chat"
+
+
+def make_event(message):
+    """
+    Returns the event about the message as the recipient sees it.
+    """
+    from habrasanta.serializers import MessageSerializer
+    return {
+        "chat": recipient_chat(message),
+        "message": MessageSerializer(message, context={ "me": message.recipient }).data,
+    }
+
+
+def publish_message(message):
+    """
+    Publishes the new message to the channel of its recipient, once the transaction is committed.
+    """
+    def publish():
+        try:
+            redis_client.publish(
+                channel_name(message.recipient_id),
+                json.dumps(make_event(message), cls=JSONEncoder),
+            )
+        except redis.RedisError as e:
+            # The message will be fetched with the next poll anyway.
+            logger.warning("Could not publish message {}: {}".format(message.id, e))
+
+    transaction.on_commit(publish)
+
+
+def get_missed_events(participation, after_id):
+    """
+    Returns the events about the messages received after the given ID, e.g. while reconnecting.
+    """
+    from habrasanta.models import Message
+    return [
+        make_event(message)
+        for message in Message.objects.select_related("sender", "recipient").filter(recipient=participation, id__gt=after_id)
+    ]
+
+
+def unread_key(participation_id):
+    return "chat-unread:{}".format(participation_id)
+
+
+def unread_messages(participations):
+    """
+    Returns the numbers of unread messages of the given participations (a queryset) per recipient,
+    the total and the ones from the santa.
+    """
+    from habrasanta.models import Message
+    return Message.objects.filter(
+        recipient__in=participations,
+        read_date=None,
+        send_date__gte=READ_DATE_INTRODUCED,
+    ).values("recipient_id").annotate(
+        total=Count("id"),
+        santa_chat=Count("id", filter=Q(sender__giftee_id=F("recipient_id"))),
+    ).order_by()
+
+
+def count_unread(participations):
+    """
+    Counts the unread messages of the given participations (a queryset) in both chats.
+    """
+    counters = {
+        participation_id: dict.fromkeys(UNREAD_CHATS, 0)
+        for participation_id in participations.values_list("id", flat=True)
+    }
+    for row in unread_messages(participations):
+        counters[row["recipient_id"]] = {
+            "santa_chat": row["santa_chat"],
+            "giftee_chat": row["total"] - row["santa_chat"],
+        }
+    return counters
+
+
+def rebuild_unread(participations):
+    """
+    Replaces the unread counters of the given participations in Redis with the numbers from the database.
+    """
+    counters = count_unread(participations)
+    pipeline = redis_client.pipeline()
+    for participation_id, unread in counters.items():
+        pipeline.hset(unread_key(participation_id), mapping=unread)
+        pipeline.expire(unread_key(participation_id), UNREAD_TTL)
+    pipeline.execute()
+    return counters
+
+
+def get_unread(participation):
+    """
+    Returns the number of unread messages in both chats of the participation.
+    """
+    from habrasanta.models import Participation
+    participations = Participation.objects.filter(pk=participation.pk)
+    try:
+        unread = redis_client.hgetall(unread_key(participation.id))
+        if not unread:
+            return rebuild_unread(participations)[participation.id]
+    except redis.RedisError as e:
+        logger.warning("Could not read unread counters of {}: {}".format(participation.id, e))
+        return count_unread(participations)[participation.id]
+    # Could become negative for a moment, if a message was read before the counter was incremented.
+    return {chat: max(int(unread.get(chat.encode(), 0)), 0) for chat in UNREAD_CHATS}
+
+
+def adjust_unread(participation_id, chat, delta):
+    """
+    Changes the unread counter of the participation once the transaction is committed.
+    """
+    def adjust():
+        try:
+            hincrby_if_exists(unread_key(participation_id), chat, delta)
+        except redis.RedisError as e:
+            logger.warning("Could not update unread counters of {}: {}".format(participation_id, e))
+
+    transaction.on_commit(adjust)
+
+
+def schedule_notification(user_id):
+    """
+    Schedules a notification about new messages to the user once the transaction is committed.
+
+    A notification that is already scheduled is not postponed, so a long conversation
+    doesn't delay it forever, and all messages of a burst end up in one notification.
+    """
+    def schedule():
+        try:
+            redis_client.zadd(NOTIFICATIONS_KEY, {user_id: time.time() + settings.CHAT_NOTIFICATION_DEBOUNCE}, nx=True)
+        except redis.RedisError as e:
+            # The messages will be found by the cron sweep.
+            logger.warning("Could not schedule notification of {}: {}".format(user_id, e))
+
+    transaction.on_commit(schedule)
+
+
+def pop_due_notifications():
+    """
+    Removes the users whose notifications are due from the schedule and returns their IDs.
+    """
+    now = time.time()
+    pipeline = redis_client.pipeline(transaction=True)
+    pipeline.zrangebyscore(NOTIFICATIONS_KEY, "-inf", now)
+    pipeline.zremrangebyscore(NOTIFICATIONS_KEY, "-inf", now)
+    user_ids, _ = pipeline.execute()
+    return [int(user_id) for user_id in user_ids]
+
+
+def unnotified_messages(now, user_ids=None):
+    """
+    Returns (user_id, count) of unread messages sent to the given users or to everybody
+    after their last notification, up to now.
+    """
+    from habrasanta.models import Message
+    messages = Message.objects.filter(
+        read_date=None,
+        send_date__gt=Coalesce(
+            F("recipient__user__last_chat_notification"),
+            now - timedelta(days=60),
+        ),
+        # Newer ones are left for the next run, they are after last_chat_notification.
+        send_date__lte=now,
+    )
+    if user_ids is not None:
+        messages = messages.filter(recipient__user__in=user_ids)
+    return messages.values_list("recipient__user").annotate(cnt=Count("id")).order_by()
+
+
+def notify_unread(user_ids=None):
+    """
+    Sends notifications about unread messages the users are not yet aware of,
+    to the given users or to everybody. Returns the number of notified users.
+
+    One aggregate query and one UPDATE, no matter how many users are notified.
+    """
+    from habrasanta.models import User
+    now = datetime.now(timezone.utc)
+    unread = list(unnotified_messages(now, user_ids))
+    if not unread:
+        return 0
+    User.objects.filter(pk__in=[user_id for user_id, _ in unread]).update(last_chat_notification=now)
+    for i in range(0, len(unread), settings.NOTIFICATION_BATCH_SIZE):
+        transaction.on_commit(partial(send_unread, unread[i:i + settings.NOTIFICATION_BATCH_SIZE]))
+    return len(unread)
+
+
+def send_unread(unread):
+    """
+    Tells the users how many new messages they have, unread is a list of (user_id, count).
+    """
+    from habrasanta.celery import send_email, send_notification
+    tasks = []
+    for user_id, count in unread:
+        plural = russian_plural(
+            count,
+            "новое сообщение", # 1
+            "новых сообщения", # 2
+            "новых сообщений" # 5
+        )
+        tasks.append(send_notification.s(
+            user_id,
+            "Вам прислали <b>{}</b> {} ".format(count, plural) +
+            "- не тяните с прочтением, наверняка там что-то важное!"
+        ))
+        tasks.append(send_email.s(
+            user_id,
+            "у вас {} {}".format(count, plural),
+            "Приветствуем!\n\n" +
+            "Вам прислали {} {} ".format(count, plural) +
+            "- не тяните с прочтением, наверняка там что-то важное!"
+        ))
+    group(tasks).apply_async()
+
+
+def format_event(event):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        event["message"]["id"],
+        event["chat"],
+        json.dumps(event["message"], cls=JSONEncoder),
+    )
+
+
+class Subscriber:
+    """
+    A single Redis connection subscribed to the channels of all streams open in this event loop.
+
+    Every stream gets its own queue of messages. The connection and the task reading it
+    are only kept while any stream is open.
+    """
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.client = None
+        self.pubsub = None
+        self.reader = None
+        # Queues and subscription confirmations by channel.
+        self.queues = {}
+        self.confirmed = {}
+
+    async def subscribe(self, channel):
+        queue = asyncio.Queue()
+        async with self.lock:
+            if self.pubsub is None:
+                self.client = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+                self.pubsub = self.client.pubsub()
+            if channel not in self.queues:
+                self.queues[channel] = set()
+                self.confirmed[channel] = asyncio.Event()
+                await self.pubsub.subscribe(channel)
+            self.queues[channel].add(queue)
+            if self.reader is None:
+                self.reader = asyncio.ensure_future(self.read())
+            confirmed = self.confirmed[channel]
+        try:
+            # Messages published before the confirmation may be lost, the caller queries them after.
+            await asyncio.wait_for(confirmed.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            logger.warning("Subscription to {} is not confirmed yet".format(channel))
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        async with self.lock:
+            queues = self.queues.get(channel, set())
+            queues.discard(queue)
+            if queues:
+                return
+            self.queues.pop(channel, None)
+            self.confirmed.pop(channel, None)
+            if self.queues:
+                await self.pubsub.unsubscribe(channel)
+                return
+            # The last stream is gone, let the connection go too.
+            self.reader.cancel()
+            pubsub, client = self.pubsub, self.client
+            self.reader = self.pubsub = self.client = None
+            await pubsub.aclose()
+            await client.aclose()
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1)
+            except redis.RedisError as e:
+                # The channels are subscribed again on reconnect.
+                logger.warning("Could not read chat messages: {}".format(e))
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"].decode()
+            if message["type"] == "subscribe" and channel in self.confirmed:
+                self.confirmed[channel].set()
+            elif message["type"] == "message":
+                for queue in self.queues.get(channel, ()):
+                    queue.put_nowait(message["data"])
+
+
+# uvicorn runs a single event loop per process, so it's one connection per process.
+subscribers = weakref.WeakKeyDictionary()
+
+
+def get_subscriber():
+    loop = asyncio.get_running_loop()
+    if loop not in subscribers:
+        subscribers[loop] = Subscriber()
+    return subscribers[loop]
+
+
+async def listen(participation, after_id, timeout, heartbeat):
+    """
+    Yields lists of new events of the participation for up to timeout seconds,
+    the missed ones first, and an empty list every heartbeat seconds if nothing happens.
+    """
+    from asgiref.sync import sync_to_async
+    subscriber = get_subscriber()
+    channel = channel_name(participation.id)
+    # Subscribe first, so nothing is lost between the query and the subscription.
+    queue = await subscriber.subscribe(channel)
+    try:
+        if after_id is not None:
+            events = await sync_to_async(get_missed_events)(participation, after_id)
+            if events:
+                after_id = events[-1]["message"]["id"]
+                yield events
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            try:
+                data = await asyncio.wait_for(queue.get(), timeout=min(heartbeat, max(deadline - loop.time(), 0)))
+            except asyncio.TimeoutError:
+                yield []
+                continue
+            event = json.loads(data)
+            # Could have been sent as a missed one already.
+            if after_id is None or event["message"]["id"] > after_id:
+                yield [event]
+    finally:
+        await subscriber.unsubscribe(channel, queue)
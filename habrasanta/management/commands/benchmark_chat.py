@@ -0,0 +1,81 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from habrasanta.chat import unnotified_messages, unread_messages
+from habrasanta.models import Message, Participation
+
+
+class Command(BaseCommand):
+    help = "Shows the plans and timings of the chat queries, with the old indexes and with the current ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--participation", type=int, help="ID of a participation (default: the latest sender)")
+        parser.add_argument("--runs", type=int, default=100, help="How many times to run each query")
+        parser.add_argument(
+            "--baseline",
+            action="store_true",
+            help="Also run the queries with the indexes of migration 0006, restored in a transaction that "
+                 "is rolled back. Locks the messages table meanwhile, don't use it on production.",
+        )
+
+    def handle(self, *args, **options):
+        participation = self.get_participation(options["participation"])
+        other = participation.giftee or getattr(participation, "santa", None)
+        if not other:
+            raise CommandError("{} has nobody to chat with".format(participation))
+        queries = [
+            ("Chat by sender and recipient (the old query)", Message.objects.filter(
+                Q(sender=participation, recipient=other) |
+                Q(sender=other, recipient=participation)
+            )),
+            ("Chat by conversation", Message.objects.filter(
+                conversation=Message.conversation_key(participation, other),
+            )),
+            ("Unread counters of the participation", unread_messages(
+                Participation.objects.filter(pk=participation.pk),
+            )),
+            ("Unread messages to notify about", unnotified_messages(timezone.now())),
+        ]
+        if options["baseline"]:
+            with transaction.atomic():
+                self.restore_baseline()
+                self.benchmark(queries, options["runs"], "baseline indexes")
+                transaction.set_rollback(True)
+        self.benchmark(queries, options["runs"], "current indexes")
+
+    def restore_baseline(self):
+        """
+        Replaces the indexes of migration 0009 with the one of 0006.
+        """
+        table = connection.ops.quote_name(Message._meta.db_table)
+        with connection.cursor() as cursor:
+            for index in Message._meta.indexes:
+                cursor.execute("DROP INDEX {}".format(connection.ops.quote_name(index.name)))
+            cursor.execute("CREATE INDEX {} ON {} ({}, {}, {})".format(
+                connection.ops.quote_name("habrasanta__sender__49dbca_idx"),
+                table,
+                *[connection.ops.quote_name(Message._meta.get_field(field).column) for field in ["sender", "recipient", "send_date"]],
+            ))
+
+    def benchmark(self, queries, runs, indexes):
+        for title, queryset in queries:
+            start = time.perf_counter()
+            for _ in range(runs):
+                rows = len(list(queryset.all()))
+            elapsed = (time.perf_counter() - start) / runs
+            self.stdout.write(self.style.MIGRATE_HEADING("{} ({})".format(title, indexes)))
+            self.stdout.write(queryset.explain())
+            self.stdout.write("{} rows, {:.3f} ms per query\n\n".format(rows, elapsed * 1000))
+
+    def get_participation(self, participation_id):
+        queryset = Participation.objects.select_related("giftee", "santa")
+        try:
+            if participation_id:
+                return queryset.get(pk=participation_id)
+            return queryset.get(pk=Message.objects.latest("send_date").sender_id)
+        except (Participation.DoesNotExist, Message.DoesNotExist):
+            raise CommandError("No such participation")
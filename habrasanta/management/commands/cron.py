@@ -1,13 +1,30 @@
-from datetime import timedelta
+import secrets
+import time
+
+from celery import group
+from contextlib import contextmanager
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils import timezone
-from django.db.models import Count, F
-from django.db.models.functions import Coalesce
-from functools import reduce
+from functools import partial
 
 from habrasanta.celery import send_email, send_notification
-from habrasanta.models import Season, Message, User, Participation
+from habrasanta.chat import notify_unread
+from habrasanta.matching import load_participants, load_previous_pairs, match_cluster, split_clusters, validate_cycle
+from habrasanta.models import Season, Participation
+
+
+class QueryCounter:
+    """
+    Counts the queries executed with connection.execute_wrapper(), even if DEBUG is off.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
 
 
 class Command(BaseCommand):
@@ -18,8 +35,11 @@ class Command(BaseCommand):
     def match_season(self, *args, **options):
         """
         Match addresses in an unmatched season with closed registration.
+
+        The number of queries doesn't depend on the number of participants.
         """
-        with transaction.atomic():
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter), transaction.atomic():
             try:
                 season = Season.objects.get(
                     registration_close__lt=timezone.now(),
@@ -29,89 +49,92 @@ class Command(BaseCommand):
                 self.stdout.write("No address matching needed")
                 return # Nothing to do.
             self.stdout.write("Gonna match {}...".format(season))
-            clusters = [["RU"], ["BY"], []]
-            for cluster in clusters:
-                participants = Participation.objects.filter(season=season).order_by("?")
-                if len(cluster):
-                    self.stdout.write("Gonna match cluster '{}'...".format(",".join(cluster)))
-                    participants = participants.filter(country__in=cluster)
-                else:
-                    self.stdout.write("Gonna match default cluster...")
-                    exclude = reduce(lambda x, y: x + y, clusters)
-                    participants = participants.exclude(country__in=exclude)
-                if len(participants) < 3:
-                    if len(participants) > 0:
-                        self.stdout.write(self.style.ERROR(
-                            "Not enough participants to match cluster {} in season {}!".format(",".join(cluster), season.id)
-                        ))
-                    continue # Nothing to do.
-                last = len(participants) - 1
-                for i, participant in enumerate(participants):
-                    if i == last:
-                        giftee = participants[0]
+            if season.match_seed is None:
+                season.match_seed = secrets.randbits(63)
+            self.stdout.write("Seed: {}".format(season.match_seed))
+            with self.phase("Loading"):
+                participation_ids, countries = load_participants(season)
+                forbidden = load_previous_pairs(season, settings.MATCHING_AVOID_RECIPROCAL)
+            giftees = {}
+            with self.phase("Matching"):
+                clusters, merges = split_clusters(countries, season.match_clusters, settings.MATCHING_MIN_CLUSTER_SIZE)
+                for cluster, size, into in merges:
+                    self.stdout.write(self.style.WARNING(
+                        "Merged cluster '{}' into '{}': {} participant(s), less than {}".format(
+                            ",".join(cluster) or "default", ",".join(into) or "default",
+                            size, settings.MATCHING_MIN_CLUSTER_SIZE)
+                    ))
+                for cluster, users in clusters:
+                    if len(cluster):
+                        self.stdout.write("Gonna match cluster '{}'...".format(",".join(cluster)))
                     else:
-                        giftee = participants[i + 1]
-                    # Make sure the user isn't matched to themself (happened once...)
-                    assert giftee != participant
-                    # TODO: Make sure the users weren't matched in another season before.
-                    participant.giftee = giftee
-                    participant.save()
-                    transaction.on_commit(send_notification.s(
-                        participant.user.id,
-                        "Вам назначен получатель подарка. Посмотреть адрес можно в " +
-                        "<a href=\"https://habra-adm.ru/{}/profile/\">профиле</a>.".format(season.id)
-                    ).delay)
-                    transaction.on_commit(send_email.s(
-                        participant.user.id,
-                        "пора отправлять подарок",
-                        "Привет, Анонимный Дед Мороз!\n\n" +
-                        "Вам назначен получатель подарка. Посмотреть адрес внука можно в профиле: " +
-                        "https://habra-adm.ru/{}/profile/".format(season.id)
-                    ).delay)
-            season.address_match = timezone.now()
-            season.save()
-            self.stdout.write(self.style.SUCCESS("Season {} matched!".format(season.id)))
+                        self.stdout.write("Gonna match default cluster...")
+                    if len(users) < 3:
+                        if len(users) > 0:
+                            self.stdout.write(self.style.ERROR(
+                                "Not enough participants to match cluster {} in season {}!".format(",".join(cluster), season.id)
+                            ))
+                        continue # Nothing to do.
+                    cycle, repeats = match_cluster(season.match_seed, cluster, users, forbidden)
+                    # Make sure nobody is matched to themself (happened once...)
+                    problems = validate_cycle(cycle, users)
+                    assert not problems, problems
+                    self.stdout.write("{} participants, {} unavoidable repeat(s) of previous seasons".format(
+                        len(cycle), repeats))
+                    for i, user_id in enumerate(cycle):
+                        giftees[user_id] = cycle[(i + 1) % len(cycle)]
+            with self.phase("Saving"):
+                Participation.objects.bulk_update([
+                    Participation(id=participation_ids[santa], giftee_id=participation_ids[giftee])
+                    for santa, giftee in giftees.items()
+                ], ["giftee"], batch_size=settings.MATCHING_BATCH_SIZE)
+                season.address_match = timezone.now()
+                # The counters may have changed meanwhile, don't overwrite them (post_save drops the cached seasons).
+                season.save(update_fields=["match_seed", "address_match"])
+                santas = list(giftees)
+                for i in range(0, len(santas), settings.MATCHING_BATCH_SIZE):
+                    transaction.on_commit(partial(
+                        self.notify_matched, season.id, santas[i:i + settings.MATCHING_BATCH_SIZE]
+                    ))
+        self.stdout.write("{} queries".format(counter.count))
+        self.stdout.write(self.style.SUCCESS("Season {} matched!".format(season.id)))
+
+    def notify_matched(self, season_id, user_ids):
+        """
+        Tells the santas that they can send their gifts now.
+        """
+        group([
+            send_notification.s(
+                user_id,
+                "Вам назначен получатель подарка. Посмотреть адрес можно в " +
+                "<a href=\"https://habra-adm.ru/{}/profile/\">профиле</a>.".format(season_id)
+            ) for user_id in user_ids
+        ] + [
+            send_email.s(
+                user_id,
+                "пора отправлять подарок",
+                "Привет, Анонимный Дед Мороз!\n\n" +
+                "Вам назначен получатель подарка. Посмотреть адрес внука можно в профиле: " +
+                "https://habra-adm.ru/{}/profile/".format(season_id)
+            ) for user_id in user_ids
+        ]).apply_async()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        yield
+        self.stdout.write("{} took {:.3f} s".format(name, time.monotonic() - start))
 
     def send_chat_notifications(self, *args, **options):
         """
         Find unread chat messages the users are not yet aware of and send out notifications.
+
+        Normally they are sent by the beat task after a debounce (see chat.schedule_notification),
+        this sweep catches the ones that were never scheduled, e.g. while Redis was unavailable.
         """
         with transaction.atomic():
-            now = timezone.now()
-            queryset = Message.objects.filter(
-                read_date=None,
-                send_date__gt=Coalesce(
-                    F("recipient__user__last_chat_notification"),
-                    now - timedelta(days=60),
-                ),
-            ).values("recipient__user").annotate(cnt=Count("id"))
-            for result in queryset:
-                plural = self.russian_plural(
-                    result["cnt"],
-                    "новое сообщение", # 1
-                    "новых сообщения", # 2
-                    "новых сообщений" # 5
-                )
-                transaction.on_commit(send_notification.s(
-                    result["recipient__user"],
-                    "Вам прислали <b>{}</b> {} ".format(result["cnt"], plural) +
-                    "- не тяните с прочтением, наверняка там что-то важное!"
-                ).delay)
-                transaction.on_commit(send_email.s(
-                    result["recipient__user"],
-                    "у вас {} {}".format(result["cnt"], plural),
-                    "Приветствуем!\n\n" +
-                    "Вам прислали {} {} ".format(result["cnt"], plural) +
-                    "- не тяните с прочтением, наверняка там что-то важное!"
-                ).delay)
-                User.objects.filter(pk=result["recipient__user"]).update(last_chat_notification=now)
-                self.stdout.write(self.style.SUCCESS("User {} notified".format(result["recipient__user"])))
-            else:
-                print("Nobody has received new messages yet")
-
-    def russian_plural(self, n, one, few, many):
-        if n % 10 == 1 and n % 100 != 11:
-            return one
-        if n % 10 >= 2 and n % 10 <= 4 and (n % 100 < 10 or n % 100 >= 20):
-            return few
-        return many
+            notified = notify_unread()
+        if notified:
+            self.stdout.write(self.style.SUCCESS("{} user(s) notified".format(notified)))
+        else:
+            self.stdout.write("Nobody has received new messages yet")
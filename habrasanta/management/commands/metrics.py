@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from habrasanta import metrics
+
+
+class Command(BaseCommand):
+    help = "Prints the counters collected by all processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset all counters afterwards")
+
+    def handle(self, *args, **options):
+        self.stdout.write(metrics.render(), ending="")
+        if options["reset"]:
+            metrics.reset()
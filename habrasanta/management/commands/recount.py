@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from habrasanta.models import Participation, Season
+
+
+class Command(BaseCommand):
+    help = "Recomputes the member, shipped and delivered counters of all seasons"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the drift, don't fix it")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            stats = {
+                row.pop("season"): row
+                for row in Participation.objects.values("season").annotate(
+                    member_count=Count("id"),
+                    shipped_count=Count("id", filter=Q(gift_shipped_at__isnull=False)),
+                    delivered_count=Count("id", filter=Q(gift_delivered_at__isnull=False)),
+                ).order_by()
+            }
+            drift = 0
+            for season in Season.objects.select_for_update().order_by("id"):
+                actual = stats.get(season.id, {})
+                changes = {}
+                for field in ["member_count", "shipped_count", "delivered_count"]:
+                    if getattr(season, field) != actual.get(field, 0):
+                        changes[field] = actual.get(field, 0)
+                if not changes:
+                    continue
+                drift += 1
+                self.stdout.write(self.style.WARNING("{}: {}".format(season, ", ".join(
+                    "{} {} -> {}".format(field, getattr(season, field), value) for field, value in changes.items()
+                ))))
+                if not options["dry_run"]:
+                    Season.objects.filter(pk=season.pk).update(**changes)
+            if drift and not options["dry_run"]:
+                # update() doesn't send post_save, so the cached seasons must be dropped by hand.
+                Season.objects.invalidate_cache()
+            if drift:
+                self.stdout.write("{} season(s) {}".format(drift, "drifted" if options["dry_run"] else "fixed"))
+            else:
+                self.stdout.write(self.style.SUCCESS("All counters are correct"))
@@ -0,0 +1,100 @@
+import random
+import secrets
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from habrasanta.matching import (
+    load_participants,
+    load_previous_pairs,
+    match_cluster,
+    pair_key,
+    split_clusters,
+    validate_cycle,
+)
+from habrasanta.models import Season, default_match_clusters
+
+
+class Command(BaseCommand):
+    help = "Runs the matching without saving anything, on an existing or a generated season"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--season", type=int, help="ID of an existing season")
+        parser.add_argument("--synthetic", type=int, metavar="N", help="Generate N participants instead")
+        parser.add_argument("--history", type=int, default=5, help="Previous seasons to generate (with --synthetic)")
+        parser.add_argument("--seed", type=int, help="Seed of the matching (default: the stored one or a random one)")
+
+    def handle(self, *args, **options):
+        tracemalloc.start()
+        try:
+            start = time.monotonic()
+            if options["synthetic"]:
+                seed = options["seed"] if options["seed"] is not None else 0
+                countries, forbidden = self.generate(options["synthetic"], options["history"], seed)
+                match_clusters = default_match_clusters()
+            else:
+                season = self.get_season(options["season"])
+                seed = options["seed"]
+                if seed is None:
+                    seed = season.match_seed if season.match_seed is not None else secrets.randbits(63)
+                _, countries = load_participants(season)
+                match_clusters = season.match_clusters
+                forbidden = load_previous_pairs(season, settings.MATCHING_AVOID_RECIPROCAL)
+            self.stdout.write("Loaded {} participants and {} previous pairs in {:.3f} s".format(
+                len(countries), len(forbidden), time.monotonic() - start))
+            self.stdout.write("Seed: {}".format(seed))
+            valid = True
+            clusters, merges = split_clusters(countries, match_clusters, settings.MATCHING_MIN_CLUSTER_SIZE)
+            for cluster, size, into in merges:
+                self.stdout.write(self.style.WARNING("Cluster {}: {} participant(s), merged into {}".format(
+                    ",".join(cluster) or "default", size, ",".join(into) or "default")))
+            for cluster, users in clusters:
+                name = ",".join(cluster) or "default"
+                if len(users) < 3:
+                    self.stdout.write(self.style.WARNING("Cluster {}: {} participants, skipped".format(name, len(users))))
+                    continue
+                cluster_start = time.monotonic()
+                cycle, repeats = match_cluster(seed, cluster, users, forbidden)
+                elapsed = time.monotonic() - cluster_start
+                problems = validate_cycle(cycle, users)
+                valid = valid and not problems
+                self.stdout.write("Cluster {}: {} participants, {} repeat(s), {:.3f} s, {}".format(
+                    name, len(users), repeats, elapsed, ", ".join(problems) or "valid"))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.stdout.write("Wall time: {:.3f} s".format(time.monotonic() - start))
+        self.stdout.write("Peak memory: {:.1f} MiB".format(peak / 1024 / 1024))
+        if not valid:
+            raise CommandError("Invalid matching")
+        self.stdout.write(self.style.SUCCESS("Nothing was saved"))
+
+    def get_season(self, season_id):
+        try:
+            if season_id:
+                return Season.objects.get(pk=season_id)
+            return Season.objects.latest()
+        except Season.DoesNotExist:
+            raise CommandError("No such season")
+
+    def generate(self, count, history, seed):
+        """
+        Generates participants from a few countries, with everyone matched in the previous seasons.
+        """
+        rng = random.Random(seed)
+        countries = {
+            user_id: rng.choices(["RU", "BY", "KZ", "UA", None], weights=[80, 8, 6, 5, 1])[0]
+            for user_id in range(1, count + 1)
+        }
+        forbidden = set()
+        users = list(countries)
+        for _ in range(history):
+            rng.shuffle(users)
+            for i in range(len(users)):
+                santa, giftee = users[i], users[(i + 1) % len(users)]
+                forbidden.add(pair_key(santa, giftee))
+                if settings.MATCHING_AVOID_RECIPROCAL:
+                    forbidden.add(pair_key(giftee, santa))
+        return countries, forbidden
@@ -29,7 +29,7 @@ PS = "P.S. Если возникли какие-то проблемы с отп
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
-        season = Season.objects.latest()
+        season = Season.objects.get_cached()
         assert not season.is_closed
         for participant in Participation.objects.filter(season=season, gift_shipped_at=None):
             text = "\n\n".join([random.choice(INTROS), random.choice(VERSES), random.choice(OUTROS), PS])
@@ -0,0 +1,198 @@
+"""
+Matching santas and giftees.
+
+Participants are identified by their user IDs, which are stable across seasons,
+and each cluster is matched into a single cycle: everyone sends a gift to the next one.
+"""
+import random
+
+from array import array
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+def pair_key(santa, giftee):
+    """
+    Packs a pair of user IDs into a single int, so millions of pairs fit in a set.
+    """
+    return santa << 32 | giftee
+
+
+def load_previous_pairs(season, avoid_reciprocal=False):
+    """
+    Returns all santa-giftee pairs of the participants of this season from the previous seasons.
+    """
+    from habrasanta.models import Participation
+    pairs = set()
+    for santa, giftee in Participation.objects.filter(
+        season__lt=season,
+        giftee__isnull=False,
+        user__in=Participation.objects.filter(season=season).values("user"),
+    ).values_list("user_id", "giftee__user_id").iterator():
+        pairs.add(pair_key(santa, giftee))
+        if avoid_reciprocal:
+            pairs.add(pair_key(giftee, santa))
+    return pairs
+
+
+def load_participants(season):
+    """
+    Returns the participation IDs and countries of all participants by their user IDs.
+    """
+    from habrasanta.models import Participation
+    participation_ids = {}
+    countries = {}
+    # Ordered, so the result is reproducible.
+    table = Participation.objects.filter(season=season).order_by("id").values_list("id", "user_id", "country")
+    for participation_id, user_id, country in table.iterator():
+        participation_ids[user_id] = participation_id
+        countries[user_id] = country
+    return participation_ids, countries
+
+
+def split_clusters(countries, clusters, min_size=3):
+    """
+    Splits the participants into clusters of countries in one pass, an empty cluster takes
+    everyone else (or the last cluster, if there is no empty one).
+
+    Clusters with less than min_size participants are merged into the last one, which is
+    merged into the largest one if it's still too small. Returns a list of non-empty
+    clusters with arrays of user IDs, and a list of merges as (cluster, size, into).
+    """
+    fallback = len(clusters) - 1
+    index = {country: i for i, cluster in enumerate(clusters) for country in cluster}
+    rest = next((i for i, cluster in enumerate(clusters) if not cluster), fallback)
+    members = [array("q") for _ in clusters]
+    for user_id, country in countries.items():
+        members[index.get(country, rest)].append(user_id)
+    merges = []
+
+    def merge(i, into):
+        merges.append((clusters[i], len(members[i]), clusters[into]))
+        members[into].extend(members[i])
+        members[i] = array("q")
+
+    for i in range(fallback):
+        if 0 < len(members[i]) < min_size:
+            merge(i, fallback)
+    if 0 < len(members[fallback]) < min_size:
+        largest = max(range(fallback + 1), key=lambda i: len(members[i]))
+        if largest != fallback and members[largest]:
+            merge(fallback, largest)
+    return [(clusters[i], members[i]) for i in range(len(clusters)) if members[i]], merges
+
+
+def match_cluster(seed, cluster, users, forbidden):
+    """
+    Returns the cycle and the number of repeats. Each cluster gets its own random
+    sequence, so changing one cluster doesn't reshuffle the others.
+    """
+    return get_engine("{}:{}".format(seed, ",".join(cluster))).match(users, forbidden)
+
+
+def count_repeats(cycle, forbidden):
+    """
+    Returns the number of pairs in the cycle, which are also in the forbidden set.
+    """
+    n = len(cycle)
+    return sum(1 for i in range(n) if pair_key(cycle[i], cycle[(i + 1) % n]) in forbidden)
+
+
+def validate_cycle(cycle, users):
+    """
+    Returns a list of problems with the cycle, e.g. somebody is missing or matched to themself.
+    """
+    problems = []
+    if len(cycle) < 3:
+        problems.append("cycle of {} participant(s) is too short".format(len(cycle)))
+    if len(set(cycle)) != len(cycle):
+        problems.append("some participants appear twice")
+    if set(cycle) != set(users):
+        problems.append("some participants are missing")
+    giftees = {santa: cycle[(i + 1) % len(cycle)] for i, santa in enumerate(cycle)}
+    for length in find_loops(giftees):
+        if length < 3:
+            problems.append("loop of {} participant(s)".format(length))
+    return problems
+
+
+def find_loops(giftees):
+    """
+    Follows the santa-giftee links and returns the lengths of all loops.
+    """
+    lengths = []
+    seen = set()
+    for start in giftees:
+        if start in seen:
+            continue
+        length = 0
+        user_id = start
+        while user_id not in seen:
+            seen.add(user_id)
+            length += 1
+            user_id = giftees.get(user_id)
+            if user_id is None:
+                break
+        lengths.append(length)
+    return lengths
+
+
+class RandomCycleEngine:
+    """
+    Shuffles the participants, previous seasons are not taken into account.
+    """
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def match(self, users, forbidden=frozenset()):
+        """
+        Returns the cycle as an array of user IDs and the number of repeated pairs.
+        """
+        # The order of the input must not affect the result, only the seed does.
+        cycle = array("q", sorted(users))
+        self.random.shuffle(cycle)
+        return cycle, count_repeats(cycle, forbidden)
+
+
+class AvoidRepeatsEngine(RandomCycleEngine):
+    """
+    Shuffles the participants and then repairs the forbidden pairs by swapping the giftee
+    with a random participant, as long as the swap doesn't introduce new forbidden pairs.
+
+    Each participant has at most one pair per previous season, so for large clusters almost
+    any swap works and the whole thing runs in linear time.
+    """
+    attempts = 100
+    passes = 3
+
+    def match(self, users, forbidden=frozenset()):
+        cycle, repeats = super().match(users, forbidden)
+        n = len(cycle)
+        for _ in range(self.passes):
+            if not repeats:
+                break
+            for i in range(n):
+                if pair_key(cycle[i], cycle[(i + 1) % n]) in forbidden:
+                    self.repair(cycle, (i + 1) % n, forbidden)
+            repeats = count_repeats(cycle, forbidden)
+        return cycle, repeats
+
+    def repair(self, cycle, a, forbidden):
+        n = len(cycle)
+        for _ in range(self.attempts):
+            b = self.random.randrange(n)
+            if b == a:
+                continue
+            cycle[a], cycle[b] = cycle[b], cycle[a]
+            # Only the pairs around the swapped positions have changed.
+            if not any(
+                pair_key(cycle[i % n], cycle[(i + 1) % n]) in forbidden
+                for i in {a - 1, a, b - 1, b}
+            ):
+                return True
+            cycle[a], cycle[b] = cycle[b], cycle[a]
+        return False
+
+
+def get_engine(seed):
+    return import_string(settings.MATCHING_ENGINE)(seed)
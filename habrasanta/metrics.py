@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+
+from collections import Counter
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# All uwsgi workers and celery processes share the same Redis hash,
+# so the numbers can be looked at from any of them.
+REDIS_KEY = "metrics"
+
+_lock = threading.Lock()
+_pending = Counter()
+_last_flush = time.monotonic()
+
+
+def metric_name(name, **labels):
+    """
+    Formats the metric name the same way Prometheus does, e.g. habr_requests_total{status="200"}.
+    """
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join(
+        "{}=\"{}\"".format(key, value) for key, value in sorted(labels.items())
+    ))
+
+
+def incr(name, amount=1, **labels):
+    """
+    Increments a counter.
+
+    Values are accumulated in memory and written to Redis at most once in
+    METRICS_FLUSH_INTERVAL seconds, so it is cheap to call this on every request.
+    """
+    global _last_flush
+    with _lock:
+        _pending[metric_name(name, **labels)] += amount
+        due = time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL
+        if due:
+            _last_flush = time.monotonic()
+    if due:
+        flush()
+
+
+def observe(name, value, buckets, **labels):
+    """
+    Records a sample of a histogram, e.g. the duration of a request in seconds.
+    """
+    for bucket in buckets:
+        if value <= bucket:
+            incr(name + "_bucket", le="{:g}".format(bucket), **labels)
+    incr(name + "_bucket", le="+Inf", **labels)
+    incr(name + "_sum", value, **labels)
+    incr(name + "_count", **labels)
+
+
+def flush():
+    """
+    Writes all pending values to Redis.
+    """
+    from habrasanta.utils import redis_client
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+    if not pending:
+        return
+    try:
+        pipeline = redis_client.pipeline(transaction=False)
+        for key, amount in pending.items():
+            pipeline.hincrbyfloat(REDIS_KEY, key, amount)
+        pipeline.execute()
+    except Exception as e:
+        # Losing some numbers is better than failing the request.
+        logger.warning("Could not flush metrics: {}".format(e))
+
+
+def snapshot():
+    """
+    Returns all metrics collected so far by all processes.
+    """
+    from habrasanta.utils import redis_client
+    flush()
+    return {
+        key.decode(): float(value)
+        for key, value in sorted(redis_client.hgetall(REDIS_KEY).items())
+    }
+
+
+def render():
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    return "".join(
+        "{} {}\n".format(key, int(value) if value.is_integer() else value)
+        for key, value in snapshot().items()
+    )
+
+
+def reset():
+    from habrasanta.utils import redis_client
+    with _lock:
+        _pending.clear()
+    redis_client.delete(REDIS_KEY)
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.8 on 2026-10-17 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0002_alter_event_typ'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='habr_avatar_url',
+            field=models.CharField(editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='habr_has_badge',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='habr_is_readonly',
+            field=models.BooleanField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='habr_karma',
+            field=models.FloatField(editable=False, null=True, verbose_name='карма'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='profile_fetched_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='профиль загружен'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.8 on 2026-10-17 17:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0003_user_habr_avatar_url_user_habr_has_badge_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='season',
+            name='match_seed',
+            field=models.BigIntegerField(editable=False, help_text='Позволяет повторить жеребьевку с тем же результатом', null=True, verbose_name='зерно жеребьевки'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.8 on 2026-10-17 17:47
+
+from django.db import migrations, models
+import habrasanta.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0004_season_match_seed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='season',
+            name='match_clusters',
+            field=models.JSONField(default=habrasanta.models.default_match_clusters, help_text='Списки кодов стран, пустой список - все остальные. Слишком маленькие кластеры объединяются с последним', verbose_name='кластеры стран'),
+        ),
+    ]
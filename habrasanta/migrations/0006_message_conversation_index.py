@@ -0,0 +1,17 @@
+# Generated by Django 4.2.8 on 2026-10-17 17:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0005_season_match_clusters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'recipient', 'send_date'], name='habrasanta__sender__49dbca_idx'),
+        ),
+    ]
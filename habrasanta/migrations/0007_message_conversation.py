@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0006_message_conversation_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.CharField(default='', editable=False, max_length=40),
+            preserve_default=False,
+        ),
+    ]
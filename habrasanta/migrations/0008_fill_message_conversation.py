@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def fill_conversation(apps, schema_editor):
+    Message = apps.get_model("habrasanta", "Message")
+    messages = Message.objects.select_related("sender").only("id", "sender__season_id", "sender_id", "recipient_id")
+    batch = []
+    for message in messages.iterator(chunk_size=2000):
+        message.conversation = "{}:{}:{}".format(
+            message.sender.season_id,
+            min(message.sender_id, message.recipient_id),
+            max(message.sender_id, message.recipient_id),
+        )
+        batch.append(message)
+        if len(batch) == 2000:
+            Message.objects.bulk_update(batch, ["conversation"])
+            batch = []
+    Message.objects.bulk_update(batch, ["conversation"])
+
+
+class Migration(migrations.Migration):
+    # Every batch is committed on its own, so the table isn't locked for the whole backfill.
+    atomic = False
+
+    dependencies = [
+        ('habrasanta', '0007_message_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_conversation, migrations.RunPython.noop),
+    ]
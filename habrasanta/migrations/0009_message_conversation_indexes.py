@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habrasanta', '0008_fill_message_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='habrasanta__sender__49dbca_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'send_date'], name='habrasanta__convers_47836d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read_date__isnull', True)), fields=['recipient', 'send_date'], name='habrasanta_message_unread_idx'),
+        ),
+    ]
@@ -1,13 +1,24 @@
+import copy
+import logging
+import redis
+import requests
 import secrets
+import time
 
+from datetime import timedelta
 from django_countries.fields import CountryField
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F
 from django.utils import timezone
 from functools import partial
 
-from habrasanta.utils import fetch_habr_profile
+from habrasanta.utils import fetch_habr_profile, hincrby_if_exists, redis_client, HabrIsDownException, LocalCache
+
+
+logger = logging.getLogger(__name__)
 
 
 class User(models.Model):
@@ -28,6 +39,15 @@ class User(models.Model):
     last_online = models.DateTimeField("последний online", default=timezone.now, null=True, editable=False)
     last_chat_notification = models.DateTimeField("последнее уведомление о новых сообщениях", blank=True, null=True, editable=False)
 
+    # Snapshot of the Habr profile, see User.profile.
+    habr_karma = models.FloatField("карма", null=True, editable=False)
+    habr_avatar_url = models.CharField(max_length=255, null=True, editable=False)
+    habr_is_readonly = models.BooleanField(null=True, editable=False)
+    habr_has_badge = models.BooleanField(null=True, editable=False)
+    profile_fetched_at = models.DateTimeField("профиль загружен", null=True, editable=False)
+
+    PROFILE_SNAPSHOT_FIELDS = ["habr_karma", "habr_avatar_url", "habr_is_readonly", "habr_has_badge", "profile_fetched_at"]
+
     USERNAME_FIELD = "login"
     REQUIRED_FIELDS = []
 
@@ -109,10 +129,63 @@ class User(models.Model):
 
     @property
     def profile(self):
+        """
+        The Habr profile of this user.
+
+        The profile is saved in the database and only fetched again after HABR_PROFILE_SNAPSHOT_MAX_AGE
+        seconds. While Habr is down or failing (fetch_habr_profile raises HabrIsDownException
+        for any error, None means the user doesn't exist), the outdated snapshot is used instead.
+        """
         if not hasattr(self, "_profile"):
-            self._profile = fetch_habr_profile(self.login)
+            snapshot = self.get_profile_snapshot(settings.HABR_PROFILE_SNAPSHOT_MAX_AGE)
+            if snapshot:
+                self._profile = snapshot
+            else:
+                try:
+                    self.remember_profile(fetch_habr_profile(self.login))
+                except (HabrIsDownException, requests.exceptions.RequestException):
+                    snapshot = self.get_profile_snapshot()
+                    if not snapshot:
+                        raise
+                    self._profile = snapshot
         return self._profile
 
+    def get_profile_snapshot(self, max_age=None):
+        """
+        Returns the profile saved in the database, unless it's older than max_age seconds.
+        """
+        if not self.profile_fetched_at:
+            return None
+        if max_age is not None and self.profile_fetched_at < timezone.now() - timedelta(seconds=max_age):
+            return None
+        return {
+            "login": self.login,
+            "avatar_url": self.habr_avatar_url,
+            "karma": self.habr_karma,
+            "has_badge": self.habr_has_badge,
+            "is_readonly": self.habr_is_readonly,
+        }
+
+    def remember_profile(self, profile):
+        if self.apply_profile(profile):
+            User.objects.filter(pk=self.pk).update(**{
+                field: getattr(self, field) for field in self.PROFILE_SNAPSHOT_FIELDS
+            })
+
+    def apply_profile(self, profile):
+        """
+        Uses the fetched profile without saving the snapshot, returns whether it must be saved.
+        """
+        self._profile = profile
+        if not profile or not self.pk:
+            return False
+        self.habr_karma = profile.get("karma")
+        self.habr_avatar_url = profile.get("avatar_url")
+        self.habr_is_readonly = profile.get("is_readonly")
+        self.habr_has_badge = profile.get("has_badge")
+        self.profile_fetched_at = timezone.now()
+        return True
+
     @property
     def karma(self):
         return self.profile["karma"]
@@ -138,6 +211,70 @@ class User(models.Model):
             self.karma >= settings.HABRASANTA_KARMA_LIMIT or self.has_badge)
 
 
+class SeasonManager(models.Manager):
+    local_cache = LocalCache(maxsize=32, timeout=60 * 60)
+
+    def get_cached(self, id=None):
+        """
+        Returns the season with the given ID or the latest season, raises Season.DoesNotExist.
+
+        Seasons are cached in the memory of each process and in Redis. Every change bumps
+        the version stored in Redis, so checking whether the cached season is still valid
+        costs a single Redis GET and no database queries.
+        """
+        key = "season:{}:{}".format(self.cache_version(), id or "latest")
+        season = self.local_cache.get(key)
+        if season is None:
+            season = cache.get(key)
+            if season is None:
+                try:
+                    season = self.get(pk=id) if id else self.latest()
+                except Season.DoesNotExist:
+                    season = False
+                cache.set(key, season, 60 * 60 * 24)
+            self.local_cache.set(key, season)
+        if not season:
+            raise Season.DoesNotExist()
+        # Don't let the caller modify the cached copy.
+        return copy.copy(season)
+
+    def cache_version(self):
+        """
+        Changes whenever any season or its counters change.
+        """
+        version = cache.get("season-version")
+        if version is None:
+            version = self.init_cache_version()
+        return version
+
+    def init_cache_version(self):
+        """
+        Starts the version from the current time, e.g. after Redis was flushed or the key evicted.
+
+        Starting from 0 again would bring back the seasons cached by the processes before.
+        """
+        version = time.time_ns() // 1000
+        cache.add("season-version", version, None)
+        return cache.get("season-version", version)
+
+    def invalidate_cache(self):
+        self.bump_cache_version()
+        # Other processes could have read the old data before the transaction was committed.
+        transaction.on_commit(self.bump_cache_version)
+
+    def bump_cache_version(self):
+        self.init_cache_version()
+        cache.incr("season-version")
+
+
+# Not a country code, so it never clashes with the counters.
+COUNTRY_STATS_BUILT = "#built"
+
+
+def default_match_clusters():
+    return [["RU"], ["BY"], []]
+
+
 class Season(models.Model):
     id = models.PositiveIntegerField("ID", primary_key=True)
 
@@ -145,6 +282,11 @@ class Season(models.Model):
     registration_close = models.DateTimeField("закрытие регистрации")
     address_match = models.DateTimeField("жеребьевка адресов", editable=False, null=True,
         help_text="Устанавливается скриптом жеребьевки автоматически")
+    match_seed = models.BigIntegerField("зерно жеребьевки", editable=False, null=True,
+        help_text="Позволяет повторить жеребьевку с тем же результатом")
+    match_clusters = models.JSONField("кластеры стран", default=default_match_clusters,
+        help_text="Списки кодов стран, пустой список - все остальные. "
+                  "Слишком маленькие кластеры объединяются с последним")
     season_close = models.DateTimeField("закрытие сезона")
 
     member_count = models.PositiveIntegerField(default=0, editable=False)
@@ -155,6 +297,8 @@ class Season(models.Model):
 
     users = models.ManyToManyField(User, related_name="seasons", through="Participation")
 
+    objects = SeasonManager()
+
     class Meta:
         get_latest_by = "id"
         verbose_name = "сезон"
@@ -178,12 +322,89 @@ class Season(models.Model):
     def is_matched(self) -> bool:
         return self.address_match is not None
 
+    def update_counters(self, **deltas):
+        """
+        Atomically changes the given counters, e.g. update_counters(member_count=-1).
+
+        Only the counter columns are written, so concurrent updates are never lost.
+        """
+        Season.objects.filter(pk=self.pk).update(**{
+            field: F(field) + delta for field, delta in deltas.items()
+        })
+        self.refresh_from_db(fields=["member_count", "shipped_count", "delivered_count"])
+        Season.objects.invalidate_cache()
+
+    @property
+    def country_stats_key(self):
+        return "season-countries:{}".format(self.id)
+
+    def get_country_stats(self):
+        """
+        Returns the number of participants from each country, the most popular countries first.
+
+        The numbers are kept in a Redis hash, which is rebuilt from the database if missing.
+        """
+        try:
+            stats = {
+                country.decode() or None: int(count)
+                for country, count in redis_client.hgetall(self.country_stats_key).items()
+            }
+        except redis.RedisError as e:
+            logger.warning("Could not read country stats of {}: {}".format(self, e))
+            stats = self.count_countries()
+        else:
+            if stats.pop(COUNTRY_STATS_BUILT, None) is None:
+                stats = self.rebuild_country_stats()
+        return dict(sorted(
+            ((country, count) for country, count in stats.items() if count > 0),
+            key=lambda item: (-item[1], item[0] or ""),
+        ))
+
+    def count_countries(self):
+        return dict(self.participation_set.values_list("country").annotate(Count("id")).order_by())
+
+    def rebuild_country_stats(self):
+        """
+        Replaces the Redis hash with the numbers from the database, fixing any drift.
+        """
+        stats = self.count_countries()
+        try:
+            pipeline = redis_client.pipeline()
+            pipeline.delete(self.country_stats_key)
+            # The marker keeps the hash of a season without participants from looking missing.
+            pipeline.hset(self.country_stats_key, mapping={
+                COUNTRY_STATS_BUILT: 1,
+                **{country or "": count for country, count in stats.items()},
+            })
+            pipeline.execute()
+        except redis.RedisError as e:
+            logger.warning("Could not rebuild country stats of {}: {}".format(self, e))
+        return stats
+
+    def adjust_country_stats(self, country, delta):
+        """
+        Changes the number of participants from the given country once the transaction is committed.
+        """
+        def on_commit():
+            try:
+                # A missing hash will be rebuilt on the next read.
+                hincrby_if_exists(self.country_stats_key, str(country or ""), delta)
+            except redis.RedisError as e:
+                logger.warning("Could not update country stats of {}: {}".format(self, e))
+
+        transaction.on_commit(on_commit)
+
     def clean(self):
         error_dict = {}
         if self.registration_close < self.registration_open:
             error_dict["registration_close"] = "Регистрация не может закрыться до открытия"
         if self.season_close < self.registration_close:
             error_dict["season_close"] = "Сезон не может закончиться до закрытия регистрации"
+        if not (
+            isinstance(self.match_clusters, list) and self.match_clusters and
+            all(isinstance(cluster, list) and all(isinstance(c, str) for c in cluster) for cluster in self.match_clusters)
+        ):
+            error_dict["match_clusters"] = "Ожидается непустой список списков кодов стран, например [[\"RU\"], []]"
         if len(error_dict):
             raise ValidationError(error_dict)
 
@@ -228,9 +449,35 @@ class Message(models.Model):
     text = models.TextField(max_length=400, db_column="body")
     send_date = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
     read_date = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
+    # Same for both directions, so a chat is a single index range.
+    conversation = models.CharField(max_length=40, editable=False)
 
     class Meta:
         ordering = ["send_date"]
+        indexes = [
+            models.Index(fields=["conversation", "send_date"]),
+            models.Index(
+                fields=["recipient", "send_date"],
+                condition=models.Q(read_date__isnull=True),
+                name="habrasanta_message_unread_idx",
+            ),
+        ]
+
+    @staticmethod
+    def conversation_key(participation, other):
+        """
+        Returns the key of the chat between the two participations, in whatever order.
+        """
+        return "{}:{}:{}".format(
+            participation.season_id,
+            min(participation.id, other.id),
+            max(participation.id, other.id),
+        )
+
+    def save(self, *args, **kwargs):
+        if not self.conversation:
+            self.conversation = Message.conversation_key(self.sender, self.recipient)
+        super().save(*args, **kwargs)
 
 
 class BanRecord(models.Model):
@@ -81,6 +81,13 @@ class MessageBulkSerializer(serializers.Serializer):
     ids = serializers.ListField(child = serializers.IntegerField(min_value=0))
 
 
+class ChatQuerySerializer(serializers.Serializer):
+    after_id = serializers.IntegerField(min_value=0, required=False)
+    since = serializers.DateTimeField(required=False)
+    before_id = serializers.IntegerField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=500, required=False)
+
+
 class TestNotificationSerializer(serializers.Serializer):
     text = serializers.CharField()
 
@@ -56,10 +56,12 @@ TEMPLATES = [
     },
 ]
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": os.getenv("REDIS_URL", "redis://localhost"),
+        "LOCATION": REDIS_URL,
     }
 }
 
@@ -84,6 +86,9 @@ REST_FRAMEWORK = {
     ],
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
     "PAGE_SIZE": 20,
+    # nginx passes the client address in REMOTE_ADDR (uwsgi_params), so X-Forwarded-For is whatever
+    # the client sent and must not be used to tell clients apart.
+    "NUM_PROXIES": 0,
 }
 
 SPECTACULAR_SETTINGS = {
@@ -145,6 +150,36 @@ HABR_TOKEN_URL = "https://habr.com/auth/o/access-token/"
 HABR_USER_INFO_URL = "https://habr.com/api/v2/me"
 HABR_USER_AGENT = os.getenv("HABR_USER_AGENT", "Habrasanta/1.0 (open source)")
 
+# Stop calling Habr for HABR_BREAKER_RESET_TIMEOUT seconds after that many failures in a row.
+HABR_BREAKER_THRESHOLD = 5
+HABR_BREAKER_RESET_TIMEOUT = 30
+
+# The profile saved in the database is used without asking Habr or Redis for that long.
+HABR_PROFILE_SNAPSHOT_MAX_AGE = 60 * 15
+
+# Profiles of users who were online recently or took part in previous seasons are fetched
+# HABR_WARMUP_LEAD_TIME seconds before the registration opens, at HABR_WARMUP_RATE Habr requests
+# per second (two per profile).
+# The lead time must be shorter than HABR_PROFILE_SNAPSHOT_MAX_AGE.
+HABR_WARMUP_LEAD_TIME = 60 * 10
+HABR_WARMUP_RATE = 10
+# Runs are scheduled this often, each one stops in time and the next one picks up the rest.
+HABR_WARMUP_INTERVAL = 60 * 5
+HABR_WARMUP_ACTIVE_DAYS = 30
+
+# Habr profiles are fresh for HABR_PROFILE_TTL seconds. After that, they are served
+# from the cache for HABR_PROFILE_STALE_TTL more seconds while being refreshed.
+HABR_PROFILE_TTL = 60
+HABR_PROFILE_STALE_TTL = 60 * 10
+# Each process also keeps the most used profiles in memory for a few seconds.
+HABR_PROFILE_LOCAL_TTL = 5
+HABR_PROFILE_LOCAL_SIZE = 1000
+# Failures are cached too, so Habr isn't asked about the same user on every request.
+HABR_PROFILE_NOT_FOUND_TTL = 60 * 10
+HABR_PROFILE_ERROR_TTL = 30
+# How long to wait for another process fetching the same profile.
+HABR_PROFILE_LOCK_TIMEOUT = 5
+
 DEFAULT_FROM_EMAIL = "Хабра-АДМ <noreply@mailgun.habrasanta.org>"
 EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
 EMAIL_HOST = os.getenv("EMAIL_HOST", "")
@@ -154,12 +189,67 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
 EMAIL_USE_TLS = True
 EMAIL_TIMEOUT = 60
 
-CELERY_BROKER_URL = os.getenv("REDIS_URL", "redis://localhost")
+CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = "django-db"
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = False
+CELERY_BEAT_SCHEDULE = {
+    "warm-up-profiles": {
+        "task": "habrasanta.celery.warm_up_profiles",
+        "schedule": HABR_WARMUP_INTERVAL,
+    },
+    "rebuild-country-stats": {
+        "task": "habrasanta.celery.rebuild_country_stats",
+        "schedule": 60 * 60,
+    },
+    "rebuild-unread-counters": {
+        "task": "habrasanta.celery.rebuild_unread_counters",
+        "schedule": 60 * 60,
+    },
+    "send-chat-notifications": {
+        "task": "habrasanta.celery.send_chat_notifications",
+        "schedule": 10,
+    },
+}
 
 HABRASANTA_ADMINS = os.getenv("HABRASANTA_ADMINS", "kafeman,negasus").split(",")
 HABRASANTA_KARMA_LIMIT = 5.0
 
+METRICS_FLUSH_INTERVAL = 10
+# Prometheus may scrape /backend/metrics from these addresses, admins from anywhere.
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# The class used to match santas and giftees, see habrasanta/matching.py.
+MATCHING_ENGINE = "habrasanta.matching.AvoidRepeatsEngine"
+# Also avoid matching somebody with their santa from a previous season.
+MATCHING_AVOID_RECIPROCAL = True
+# Smaller clusters are merged into the last cluster of the season (the fallback).
+MATCHING_MIN_CLUSTER_SIZE = 3
+# Giftees are saved and notifications are queued in batches of this size.
+MATCHING_BATCH_SIZE = 1000
+# Chat notifications are queued in batches of this size.
+NOTIFICATION_BATCH_SIZE = 1000
+# Notifications about new messages are sent this many seconds after the first one of a burst.
+CHAT_NOTIFICATION_DEBOUNCE = 60 * 2
+
+# Chat streams are closed after this many seconds, EventSource reconnects by itself.
+CHAT_STREAM_TIMEOUT = 5 * 60
+# Keeps proxies from closing an idle stream.
+CHAT_STREAM_HEARTBEAT = 15
+# For clients without EventSource.
+CHAT_LONG_POLL_TIMEOUT = 25
+
+# Token buckets of write endpoints: (burst, requests per second).
+# Many users may share an IP address, so that limit is looser.
+RATE_LIMITS = {
+    "chat": {"participation": (5, 1 / 10), "ip": (30, 1)},
+    "participation": {"participation": (5, 1 / 30), "ip": (30, 1)},
+}
+
+# Country stats are public and may be cached by browsers and the CDN for this long.
+COUNTRY_STATS_MAX_AGE = 60
+
+# How long the rendered frontend shell is kept in the cache, at most.
+FRONTEND_CACHE_TTL = 60 * 60
+
 with open(BASE_DIR / "assets-manifest.json", "r") as f:
     WEBPACK = json.load(f)
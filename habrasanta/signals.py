@@ -32,3 +32,7 @@ def log_user_logout(sender, user, request, **kwargs):
         sub=user,
         ip_address=request.META["REMOTE_ADDR"],
     )
+
+
+def invalidate_season_cache(sender, **kwargs):
+    sender.objects.invalidate_cache()
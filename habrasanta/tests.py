@@ -1,12 +1,58 @@
+import asyncio
+import io
 import json
+import re
+import requests
+import threading
+import time
 
+from asgiref.sync import async_to_sync
 from datetime import timedelta
+from django.contrib.auth.signals import user_logged_in
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from django.utils.http import urlencode
 from rest_framework.test import APIClient
+from unittest import mock
 
+from habrasanta import metrics, views
+from habrasanta.chat import NOTIFICATIONS_KEY, get_subscriber, get_unread, listen, schedule_notification, unread_key
+from habrasanta.celery import (
+    rebuild_country_stats,
+    rebuild_unread_counters,
+    send_chat_notifications,
+    warm_up_profiles,
+)
+from habrasanta.management.commands import cron
+from habrasanta.matching import (
+    AvoidRepeatsEngine,
+    RandomCycleEngine,
+    count_repeats,
+    load_participants,
+    pair_key,
+    split_clusters,
+    validate_cycle,
+)
 from habrasanta.models import Message, Participation, Season, User
+from habrasanta.utils import (
+    CircuitBreaker,
+    endpoint_template,
+    HabrIsDownException,
+    HabrSession,
+    HabrUserNotFoundException,
+    cache_habr_profile,
+    fetch_habr_profile,
+    local_profiles,
+    prefetch_habr_profiles,
+    redis_client,
+    refresh_habr_profile,
+    request_habr_profile,
+    TokenBucket,
+)
 
 
 class UserTestCase(TestCase):
@@ -55,6 +101,329 @@ class UserTestCase(TestCase):
         u.is_banned = True
         self.assertFalse(u.can_participate)
 
+    @mock.patch("habrasanta.models.fetch_habr_profile")
+    def test_profile_snapshot(self, fetch_habr_profile):
+        fetch_habr_profile.return_value = {
+            "login": "kafeman",
+            "karma": 42,
+            "has_badge": False,
+            "is_readonly": False,
+            "avatar_url": None,
+        }
+        u = User.objects.create(login="kafeman")
+        self.assertEqual(u.karma, 42)
+        self.assertEqual(fetch_habr_profile.call_count, 1)
+        # The profile is saved in the database.
+        u = User.objects.get(login="kafeman")
+        self.assertEqual(u.karma, 42)
+        self.assertEqual(fetch_habr_profile.call_count, 1)
+        # The outdated snapshot is used while Habr is down.
+        User.objects.filter(login="kafeman").update(profile_fetched_at=timezone.now() - timedelta(days=1))
+        fetch_habr_profile.side_effect = HabrIsDownException()
+        u = User.objects.get(login="kafeman")
+        self.assertEqual(u.karma, 42)
+        self.assertEqual(fetch_habr_profile.call_count, 2)
+        u = User.objects.create(login="negasus")
+        with self.assertRaises(HabrIsDownException):
+            u.karma
+
+    def test_profile_snapshot_while_habr_fails(self):
+        cache.delete_many(["profile:kafeman", "profile-lock:kafeman"])
+        local_profiles.clear()
+        self.addCleanup(cache.delete, "profile:kafeman")
+        self.addCleanup(local_profiles.clear)
+        User.objects.create(
+            login="kafeman",
+            habr_karma=42,
+            habr_has_badge=False,
+            habr_is_readonly=False,
+            profile_fetched_at=timezone.now() - timedelta(days=1),
+        )
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=503)) as get:
+            self.assertEqual(User.objects.get(login="kafeman").karma, 42)
+            # The failure is cached for a while, the snapshot is still used meanwhile.
+            self.assertEqual(User.objects.get(login="kafeman").karma, 42)
+        self.assertEqual(get.call_count, 1)
+
+
+class HabrProfileTestCase(TestCase):
+    PROFILE = {
+        "login": "kafeman",
+        "karma": 42,
+        "has_badge": False,
+        "is_readonly": False,
+        "avatar_url": None,
+    }
+
+    def setUp(self):
+        cache.delete_many(["profile:kafeman", "profile-lock:kafeman", "user-not-found:kafeman"])
+        local_profiles.clear()
+
+    @mock.patch("habrasanta.utils.request_habr_profile", return_value=PROFILE)
+    def test_cache(self, request_habr_profile):
+        self.assertEqual(fetch_habr_profile("kafeman"), self.PROFILE)
+        self.assertEqual(request_habr_profile.call_count, 1)
+        # Served from the memory of this process.
+        self.assertEqual(fetch_habr_profile("kafeman"), self.PROFILE)
+        self.assertEqual(request_habr_profile.call_count, 1)
+        # Served from Redis.
+        local_profiles.clear()
+        self.assertEqual(fetch_habr_profile("kafeman"), self.PROFILE)
+        self.assertEqual(request_habr_profile.call_count, 1)
+
+    @mock.patch("habrasanta.utils.schedule_profile_refresh")
+    @mock.patch("habrasanta.utils.request_habr_profile", return_value=PROFILE)
+    def test_stale_while_revalidate(self, request_habr_profile, schedule_profile_refresh):
+        cache.set("profile:kafeman", {
+            "profile": dict(self.PROFILE, karma=13),
+            "fetched_at": time.time() - 120,
+        })
+        # The stale profile is returned immediately and refreshed in the background.
+        self.assertEqual(fetch_habr_profile("kafeman")["karma"], 13)
+        self.assertEqual(request_habr_profile.call_count, 0)
+        schedule_profile_refresh.assert_called_once_with("kafeman")
+
+    def test_single_flight(self):
+        def slow_request(username):
+            time.sleep(0.2)
+            return self.PROFILE
+        with mock.patch("habrasanta.utils.request_habr_profile", side_effect=slow_request) as request_habr_profile:
+            threads = [threading.Thread(target=fetch_habr_profile, args=("kafeman",)) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(request_habr_profile.call_count, 1)
+
+    @mock.patch("habrasanta.utils.request_habr_profile", return_value=PROFILE)
+    def test_single_flight_across_processes(self, request_habr_profile):
+        # Pretend another process is fetching the profile right now.
+        cache.set("profile-lock:kafeman", True)
+        threading.Timer(0.2, cache_habr_profile, args=("kafeman", dict(self.PROFILE, karma=13))).start()
+        self.assertEqual(fetch_habr_profile("kafeman")["karma"], 13)
+        self.assertEqual(request_habr_profile.call_count, 0)
+
+    @mock.patch("habrasanta.celery.send_notification.delay")
+    def test_not_found(self, send_notification):
+        boomburum = User.objects.create(login="Boomburum")
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=404)) as get:
+            self.assertIsNone(fetch_habr_profile("kafeman"))
+            local_profiles.clear()
+            self.assertIsNone(fetch_habr_profile("kafeman"))
+            self.assertEqual(get.call_count, 1) # no whois for a missing user
+        send_notification.assert_called_once_with(boomburum.id, "Пользователя 'kafeman' больше нет с нами.")
+        # Boomburum is notified only once a day.
+        cache.delete("profile:kafeman")
+        local_profiles.clear()
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=404)):
+            self.assertIsNone(fetch_habr_profile("kafeman"))
+        self.assertEqual(send_notification.call_count, 1)
+
+    def test_error(self):
+        # A failure is not taken for a missing user, neither right away nor while it's cached.
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=500)) as get:
+            self.assertRaises(HabrIsDownException, fetch_habr_profile, "kafeman")
+            self.assertRaises(HabrIsDownException, fetch_habr_profile, "kafeman")
+            local_profiles.clear()
+            self.assertRaises(HabrIsDownException, fetch_habr_profile, "kafeman")
+            self.assertEqual(get.call_count, 1)
+        # The stale profile is not replaced by an error.
+        cache.set("profile:kafeman", {
+            "profile": self.PROFILE,
+            "fetched_at": time.time() - 120,
+        })
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=500)):
+            self.assertRaises(HabrIsDownException, refresh_habr_profile, "kafeman")
+        local_profiles.clear()
+        with mock.patch("habrasanta.utils.schedule_profile_refresh"):
+            self.assertEqual(fetch_habr_profile("kafeman"), self.PROFILE)
+
+    def test_prefetch(self):
+        cache.delete_many(["profile:negasus", "profile:Boomburum"])
+        cache_habr_profile("kafeman", self.PROFILE)
+        local_profiles.clear()
+        users = [User(login="kafeman"), User(login="negasus"), User(login="Boomburum"), User(login="negasus")]
+        with mock.patch("habrasanta.utils.request_habr_profile", side_effect=lambda username: dict(self.PROFILE, login=username)) as request_habr_profile:
+            prefetch_habr_profiles(users)
+            self.assertEqual(sorted(call.args[0] for call in request_habr_profile.call_args_list), ["Boomburum", "negasus"])
+            self.assertEqual([user.profile["login"] for user in users], ["kafeman", "negasus", "Boomburum", "negasus"])
+            self.assertEqual(request_habr_profile.call_count, 2)
+
+    def test_prefetch_saves_snapshots_at_once(self):
+        cache.delete_many(["profile:negasus", "profile:Boomburum"])
+        cache_habr_profile("kafeman", self.PROFILE)
+        local_profiles.clear()
+        for login in ["kafeman", "negasus", "Boomburum"]:
+            User.objects.create(login=login)
+        users = list(User.objects.order_by("id"))
+        with mock.patch("habrasanta.utils.request_habr_profile", side_effect=lambda username: dict(self.PROFILE, login=username)):
+            with self.assertNumQueries(1):
+                prefetch_habr_profiles(users)
+        self.assertEqual(User.objects.filter(habr_karma=42, profile_fetched_at__isnull=False).count(), 3)
+
+
+def fake_habr_api(card_status=200, whois_status=200):
+    def get(url, **kwargs):
+        if url.endswith("/card"):
+            return mock.Mock(status_code=card_status, url=url, text="", json=lambda: {
+                "alias": "kafeman",
+                "avatarUrl": None,
+                "scoreStats": { "score": 42 },
+                "isReadonly": False,
+            })
+        return mock.Mock(status_code=whois_status, url=url, text="", json=lambda: {
+            "badgets": [{ "title": "Дед Мороз" }],
+        })
+    return mock.Mock(side_effect=get)
+
+
+class RequestHabrProfileTestCase(TestCase):
+    def test_success(self):
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api()) as get:
+            profile = request_habr_profile("kafeman")
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(profile, {
+            "login": "kafeman",
+            "avatar_url": None,
+            "karma": 42,
+            "has_badge": True,
+            "is_readonly": False,
+        })
+
+    def test_failure(self):
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=404)) as get:
+            self.assertRaises(HabrUserNotFoundException, request_habr_profile, "kafeman")
+        # No whois for missing users or while Habr is failing.
+        self.assertEqual(get.call_count, 1)
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=502)) as get:
+            self.assertRaises(HabrIsDownException, request_habr_profile, "kafeman")
+        self.assertEqual(get.call_count, 1)
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(whois_status=502)):
+            self.assertRaises(HabrIsDownException, request_habr_profile, "kafeman")
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(card_status=500)) as get:
+            self.assertIsNone(request_habr_profile("kafeman"))
+        self.assertEqual(get.call_count, 1)
+        with mock.patch("habrasanta.utils.session.get", fake_habr_api(whois_status=403)):
+            self.assertIsNone(request_habr_profile("kafeman"))
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("test", threshold=3, reset_timeout=30)
+        for suffix in ["open", "failures", "probe"]:
+            redis_client.delete(self.breaker.key(suffix))
+        self.session = HabrSession(self.breaker)
+
+    def test_open_and_close(self):
+        with mock.patch("requests.Session.request", return_value=mock.Mock(status_code=502)) as request:
+            for _ in range(3):
+                self.assertEqual(self.session.get("https://habr.com/").status_code, 502)
+            # Habr is not called anymore.
+            self.assertRaises(HabrIsDownException, self.session.get, "https://habr.com/")
+            self.assertEqual(request.call_count, 3)
+        # Pretend reset_timeout has passed, a single probe is allowed.
+        redis_client.delete(self.breaker.key("open"))
+        with mock.patch("requests.Session.request", return_value=mock.Mock(status_code=200)) as request:
+            self.breaker.before_request()
+            self.assertRaises(HabrIsDownException, self.session.get, "https://habr.com/")
+            redis_client.delete(self.breaker.key("probe"))
+            self.assertEqual(self.session.get("https://habr.com/").status_code, 200)
+            self.assertEqual(self.session.get("https://habr.com/").status_code, 200)
+            self.assertEqual(request.call_count, 2)
+
+    def test_timeouts(self):
+        with mock.patch("requests.Session.request", side_effect=requests.exceptions.Timeout()):
+            for _ in range(3):
+                self.assertRaises(requests.exceptions.Timeout, self.session.get, "https://habr.com/")
+        self.assertRaises(HabrIsDownException, self.session.get, "https://habr.com/")
+
+
+@override_settings(HABR_WARMUP_RATE=1000)
+class WarmUpProfilesTestCase(TestCase):
+    @mock.patch("habrasanta.utils.refresh_habr_profile")
+    def test_warm_up(self, refresh_habr_profile):
+        refresh_habr_profile.side_effect = lambda username: {
+            "login": username,
+            "karma": 42,
+            "has_badge": False,
+            "is_readonly": False,
+            "avatar_url": None,
+        }
+        old_season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=400),
+            registration_close=timezone.now() - timedelta(days=390),
+            season_close=timezone.now() - timedelta(days=360),
+        )
+        veteran = User.objects.create(login="kafeman", last_online=timezone.now() - timedelta(days=300))
+        Participation.objects.create(season=old_season, user=veteran)
+        User.objects.create(login="negasus")
+        User.objects.create(login="Boomburum", last_online=timezone.now() - timedelta(days=300))
+        self.assertIsNone(warm_up_profiles())
+        Season.objects.create(
+            id=2008,
+            registration_open=timezone.now() + timedelta(minutes=5),
+            registration_close=timezone.now() + timedelta(days=10),
+            season_close=timezone.now() + timedelta(days=40),
+        )
+        result = warm_up_profiles()
+        self.assertEqual(result["season"], 2008)
+        self.assertEqual(result["warmed"], 2)
+        self.assertEqual(sorted(call.args[0] for call in refresh_habr_profile.call_args_list), ["kafeman", "negasus"])
+        self.assertEqual(User.objects.get(login="kafeman").habr_karma, 42)
+        # Nothing left to do during the next run.
+        self.assertEqual(warm_up_profiles()["warmed"], 0)
+
+    @mock.patch("habrasanta.utils.refresh_habr_profile")
+    def test_no_overlap(self, refresh_habr_profile):
+        Season.objects.create(
+            id=2008,
+            registration_open=timezone.now() + timedelta(minutes=5),
+            registration_close=timezone.now() + timedelta(days=10),
+            season_close=timezone.now() + timedelta(days=40),
+        )
+        User.objects.create(login="negasus", last_online=timezone.now())
+        cache.set("warm-up-profiles", True)
+        try:
+            self.assertIsNone(warm_up_profiles())
+        finally:
+            cache.delete("warm-up-profiles")
+        refresh_habr_profile.assert_not_called()
+        # A run that is out of time leaves the rest to the next one.
+        with override_settings(HABR_WARMUP_INTERVAL=30):
+            self.assertEqual(warm_up_profiles()["warmed"], 0)
+        refresh_habr_profile.assert_not_called()
+        self.assertTrue(cache.add("warm-up-profiles", True, 1))
+        cache.delete("warm-up-profiles")
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_endpoint_template(self):
+        self.assertEqual(endpoint_template("https://habr.com/api/v2/users/kafeman/card"), "/users/{}/card")
+        self.assertEqual(endpoint_template("https://habr.com/api/v2/me/notifications/list"), "/me/notifications/list")
+        self.assertEqual(endpoint_template("https://habr.com/auth/o/access-token/"), "/auth/o/access-token/")
+
+    def test_habr_requests(self):
+        session = HabrSession(CircuitBreaker("metrics", threshold=3, reset_timeout=30))
+        with mock.patch("requests.Session.request", return_value=mock.Mock(status_code=200)):
+            session.get("https://habr.com/api/v2/users/kafeman/card")
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['habr_requests_total{endpoint="/users/{}/card",method="GET",status="200"}'], 1)
+        self.assertEqual(snapshot['habr_request_duration_seconds_count{endpoint="/users/{}/card",method="GET"}'], 1)
+        self.assertEqual(snapshot['habr_request_duration_seconds_bucket{endpoint="/users/{}/card",le="+Inf",method="GET"}'], 1)
+
+    def test_view(self):
+        metrics.incr("test_total")
+        client = APIClient()
+        response = client.get("/backend/metrics", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 404)
+        response = client.get("/backend/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"test_total 1\n", response.content)
+
 
 class SeasonTestCase(TestCase):
     def test_str(self):
@@ -82,7 +451,351 @@ class SeasonTestCase(TestCase):
         s.address_match = timezone.now()
         self.assertTrue(s.is_matched)
 
+    def test_update_counters(self):
+        s = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now(),
+            registration_close=timezone.now(),
+            season_close=timezone.now(),
+        )
+        stale = Season.objects.get(pk=2007)
+        s.update_counters(member_count=1)
+        stale.update_counters(member_count=1, shipped_count=1)
+        self.assertEqual(stale.member_count, 2)
+        self.assertEqual(stale.shipped_count, 1)
+        s = Season.objects.get(pk=2007)
+        self.assertEqual(s.member_count, 2)
+        self.assertEqual(s.shipped_count, 1)
+        self.assertEqual(s.delivered_count, 0)
+
+
+class SeasonCacheTestCase(TestCase):
+    def setUp(self):
+        Season.objects.invalidate_cache()
+
+    def test_get_cached(self):
+        self.assertRaises(Season.DoesNotExist, Season.objects.get_cached)
+        Season.objects.create(
+            id=2007,
+            registration_open=timezone.now(),
+            registration_close=timezone.now(),
+            season_close=timezone.now(),
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(Season.objects.get_cached().id, 2007)
+        with self.assertNumQueries(0):
+            self.assertEqual(Season.objects.get_cached().id, 2007)
+        # Counters are updated with a direct UPDATE query, which must invalidate the cache too.
+        Season.objects.get(pk=2007).update_counters(member_count=1)
+        self.assertEqual(Season.objects.get_cached().member_count, 1)
+        self.assertEqual(Season.objects.get_cached(2007).member_count, 1)
+        Season.objects.filter(pk=2007).delete()
+        self.assertRaises(Season.DoesNotExist, Season.objects.get_cached, 2007)
+
+    def test_cache_version_lost(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now(),
+            registration_close=timezone.now(),
+            season_close=timezone.now(),
+        )
+        version = Season.objects.cache_version()
+        # A process still has a season cached with version 0, then Redis is flushed.
+        Season.objects.local_cache.set("season:0:2007", season)
+        cache.delete("season-version")
+        Season.objects.filter(pk=2007).update(member_count=7)
+        self.assertGreater(Season.objects.cache_version(), version)
+        self.assertEqual(Season.objects.get_cached(2007).member_count, 7)
+
+    def test_frontend(self):
+        client = APIClient()
+        response = client.get("/2007/")
+        self.assertEqual(response.status_code, 404)
+        Season.objects.create(
+            id=2007,
+            registration_open=timezone.now(),
+            registration_close=timezone.now(),
+            season_close=timezone.now(),
+        )
+        response = client.get("/")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/2007/")
+        with CaptureQueriesContext(connection) as context:
+            response = client.get("/")
+        self.assertEqual(response["Location"], "/2007/")
+        # Only the savepoint of ATOMIC_REQUESTS.
+        self.assertFalse([q for q in context.captured_queries if "SAVEPOINT" not in q["sql"]])
+
+    @override_settings(WEBPACK={
+        name: {"src": "/" + name, "integrity": "sha384-test"}
+        for name in ["social.jpg", "apple-touch-icon.png", "favicon-32x32.png", "favicon-16x16.png", "main.css", "main.js"]
+    })
+    def test_frontend_page(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=1),
+            registration_close=timezone.now() + timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=2),
+        )
+        views.FrontendView.local_cache.clear()
+        client = APIClient()
+        response = client.get("/2007/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"member_count": 0', response.content)
+        etag = response["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        with CaptureQueriesContext(connection) as context:
+            response = client.get("/2007/profile/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertFalse([q for q in context.captured_queries if "SAVEPOINT" not in q["sql"]])
+        season.update_counters(member_count=1)
+        response = client.get("/2007/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'"member_count": 1', response.content)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class RecountCommandTestCase(TestCase):
+    def test_recount(self):
+        season = Season.objects.create(
+            id=2007,
+            member_count=5,
+            shipped_count=0,
+            delivered_count=1,
+            registration_open=timezone.now(),
+            registration_close=timezone.now(),
+            season_close=timezone.now(),
+        )
+        Participation.objects.create(season=season, user=User.objects.create(login="kafeman"), gift_shipped_at=timezone.now())
+        Participation.objects.create(season=season, user=User.objects.create(login="negasus"))
+        self.assertEqual(Season.objects.get_cached(2007).member_count, 5)
+        out = io.StringIO()
+        call_command("recount", "--dry-run", stdout=out)
+        self.assertIn("member_count 5 -> 2, shipped_count 0 -> 1, delivered_count 1 -> 0", out.getvalue())
+        self.assertEqual(Season.objects.get(pk=2007).member_count, 5)
+        call_command("recount", stdout=out)
+        season = Season.objects.get(pk=2007)
+        self.assertEqual(season.member_count, 2)
+        self.assertEqual(season.shipped_count, 1)
+        self.assertEqual(season.delivered_count, 0)
+        self.assertEqual(Season.objects.get_cached(2007).member_count, 2)
+        out = io.StringIO()
+        call_command("recount", stdout=out)
+        self.assertIn("All counters are correct", out.getvalue())
+
+
+class BenchmarkChatCommandTestCase(TestCase):
+    def setUp(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        self.santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        self.santa.giftee = Participation.objects.create(season=season, user=User.objects.create(login="exploitable"))
+        self.santa.save()
+        Message.objects.create(sender=self.santa, recipient=self.santa.giftee, text="Hello")
+
+    def benchmark(self, **options):
+        out = io.StringIO()
+        call_command("benchmark_chat", runs=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_benchmark(self):
+        out = self.benchmark()
+        self.assertIn("Chat by conversation (current indexes)", out)
+        self.assertIn("Unread messages to notify about (current indexes)", out)
+        self.assertNotIn("baseline indexes", out)
+
+    def test_baseline(self):
+        out = self.benchmark(participation=self.santa.giftee.id, baseline=True)
+        # The same queries with both index sets.
+        for title in ["Chat by sender and recipient (the old query)", "Chat by conversation", "Unread counters of the participation"]:
+            self.assertIn("{} (baseline indexes)".format(title), out)
+            self.assertIn("{} (current indexes)".format(title), out)
+        # The indexes are back after the run.
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, Message._meta.db_table)
+        self.assertIn("habrasanta_message_unread_idx", indexes)
+        self.assertNotIn("habrasanta__sender__49dbca_idx", indexes)
+
+    def test_nobody_to_chat_with(self):
+        lonely = Participation.objects.create(season=self.santa.season, user=User.objects.create(login="lonely"))
+        with self.assertRaises(CommandError):
+            self.benchmark(participation=lonely.id)
+
+
+class MatchingTestCase(TestCase):
+    def test_avoid_repeats(self):
+        users = list(range(1, 101))
+        # Last year, everyone sent a gift to the next one.
+        forbidden = {pair_key(users[i], users[(i + 1) % 100]) for i in range(100)}
+        cycle, repeats = RandomCycleEngine(42).match(users, forbidden)
+        self.assertEqual(validate_cycle(cycle, users), [])
+        cycle, repeats = AvoidRepeatsEngine(42).match(users, forbidden)
+        self.assertEqual(validate_cycle(cycle, users), [])
+        self.assertEqual(repeats, 0)
+        self.assertEqual(count_repeats(cycle, forbidden), 0)
+
+    def test_unavoidable_repeats(self):
+        forbidden = {pair_key(a, b) for a in [1, 2, 3] for b in [1, 2, 3] if a != b}
+        cycle, repeats = AvoidRepeatsEngine(42).match([1, 2, 3], forbidden)
+        self.assertEqual(sorted(cycle), [1, 2, 3])
+        self.assertEqual(repeats, 3)
+
+    def test_reproducible(self):
+        users = list(range(1000))
+        cycle, _ = AvoidRepeatsEngine(1).match(users)
+        self.assertEqual(AvoidRepeatsEngine(1).match(list(reversed(users)))[0], cycle)
+        self.assertNotEqual(AvoidRepeatsEngine(2).match(users)[0], cycle)
+
+    def test_match_season(self):
+        previous = Season.objects.create(
+            id=2006,
+            registration_open=timezone.now() - timedelta(days=400),
+            registration_close=timezone.now() - timedelta(days=390),
+            address_match=timezone.now() - timedelta(days=390),
+            season_close=timezone.now() - timedelta(days=360),
+        )
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+            match_seed=42,
+        )
+        users = [User.objects.create(login="user{}".format(i)) for i in range(8)]
+        giftee = None
+        for user in reversed(users):
+            giftee = Participation.objects.create(season=previous, user=user, country="RU", giftee=giftee)
+        for user in users:
+            Participation.objects.create(season=season, user=user, country="RU")
+        out = io.StringIO()
+        call_command("cron", stdout=out)
+        self.assertIn("Seed: 42", out.getvalue())
+        self.assertIn("8 participants, 0 unavoidable repeat(s)", out.getvalue())
+        previous_pairs = set(Participation.objects.filter(season=previous, giftee__isnull=False).values_list(
+            "user_id", "giftee__user_id"))
+        pairs = set(Participation.objects.filter(season=season).values_list("user_id", "giftee__user_id"))
+        self.assertEqual(len(pairs), 8)
+        self.assertFalse(pairs & previous_pairs)
+        self.assertEqual({santa for santa, _ in pairs}, {giftee for _, giftee in pairs})
+        self.assertIsNotNone(Season.objects.get(pk=2007).address_match)
+
+    def test_match_season_keeps_counters(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+        )
+        for i in range(3):
+            Participation.objects.create(season=season, user=User.objects.create(login="user{}".format(i)), country="RU")
+        cached = Season.objects.get_cached(2007)
+
+        def load_and_ship(season):
+            # Somebody marks their gift as shipped while the season is being matched.
+            Season.objects.get(pk=season.pk).update_counters(shipped_count=1)
+            return load_participants(season)
+
+        with mock.patch("habrasanta.management.commands.cron.load_participants", side_effect=load_and_ship):
+            call_command("cron", stdout=io.StringIO())
+        season = Season.objects.get(pk=2007)
+        self.assertEqual(season.shipped_count, 1)
+        self.assertIsNotNone(season.address_match)
+        self.assertIsNotNone(season.match_seed)
+        self.assertIsNone(cached.address_match)
+        self.assertIsNotNone(Season.objects.get_cached(2007).address_match)
+
+    def test_match_season_queries(self):
+        queries = []
+        for year, count in [(2007, 5), (2008, 50)]:
+            season = Season.objects.create(
+                id=year,
+                registration_open=timezone.now() - timedelta(days=2),
+                registration_close=timezone.now() - timedelta(days=1),
+                season_close=timezone.now() + timedelta(days=30),
+            )
+            for i in range(count):
+                user, _ = User.objects.get_or_create(login="user{}".format(i))
+                Participation.objects.create(season=season, user=user, country="RU")
+            out = io.StringIO()
+            with mock.patch("habrasanta.management.commands.cron.group") as group:
+                with self.captureOnCommitCallbacks(execute=True):
+                    call_command("cron", stdout=out)
+            self.assertEqual(len(group.call_args.args[0]), count * 2)
+            queries.append(re.search(r"(\d+) queries", out.getvalue()).group(1))
+            self.assertIn("Saving took", out.getvalue())
+        self.assertEqual(queries[0], queries[1])
+
+    def test_split_clusters(self):
+        countries = {1: "RU", 2: "RU", 3: "RU", 4: "BY", 5: "KZ", 6: None, 7: "UA", 8: "BY"}
+        clusters, merges = split_clusters(countries, [["RU"], ["BY"], []])
+        self.assertEqual(merges, [(["BY"], 2, [])])
+        self.assertEqual([(cluster, list(users)) for cluster, users in clusters], [
+            (["RU"], [1, 2, 3]),
+            ([], [5, 6, 7, 4, 8]),
+        ])
+        # The fallback is merged into the largest cluster if it's still too small.
+        clusters, merges = split_clusters({1: "RU", 2: "RU", 3: "RU", 4: "KZ"}, [["RU"], ["BY"], []])
+        self.assertEqual(merges, [([], 1, ["RU"])])
+        self.assertEqual([(cluster, sorted(users)) for cluster, users in clusters], [(["RU"], [1, 2, 3, 4])])
+
+    def test_match_season_merges_clusters(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+            match_clusters=[["RU"], ["KZ"], ["BY", "UA"]],
+        )
+        for i, country in enumerate(["RU", "RU", "RU", "KZ", "BY", "UA", "DE"]):
+            Participation.objects.create(season=season, user=User.objects.create(login="user{}".format(i)), country=country)
+        out = io.StringIO()
+        call_command("cron", stdout=out)
+        self.assertIn("Merged cluster 'KZ' into 'BY,UA': 1 participant(s), less than 3", out.getvalue())
+        self.assertFalse(Participation.objects.filter(season=season, giftee__isnull=True).exists())
+        self.assertEqual(
+            {Participation.objects.get(user__login=login).giftee.country for login in ["user3", "user4", "user5", "user6"]},
+            {"KZ", "BY", "UA", "DE"},
+        )
+
+    def test_simulate_match(self):
+        out = io.StringIO()
+        call_command("simulate_match", "--synthetic", "500", "--history", "3", stdout=out)
+        self.assertIn("Cluster RU:", out.getvalue())
+        self.assertIn("0 repeat(s)", out.getvalue())
+        self.assertNotIn("loop of", out.getvalue())
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+        )
+        for i in range(4):
+            Participation.objects.create(season=season, user=User.objects.create(login="user{}".format(i)), country="BY")
+        out = io.StringIO()
+        call_command("simulate_match", "--season", "2007", stdout=out)
+        self.assertIn("Cluster BY: 4 participants, 0 repeat(s)", out.getvalue())
+        self.assertIn("Nothing was saved", out.getvalue())
+        self.assertFalse(Participation.objects.filter(giftee__isnull=False).exists())
+        self.assertIsNone(Season.objects.get(pk=2007).address_match)
+
+
+# The tests below make a lot of requests, rate limits are tested separately.
+@override_settings(RATE_LIMITS={
+    scope: {"participation": (1000, 1), "ip": (1000, 1)} for scope in ["chat", "participation"]
+})
 class SeasonViewSetTestCase(TestCase):
+    def setUp(self):
+        # Seasons of the previous tests may still be cached in Redis.
+        Season.objects.invalidate_cache()
+        redis_client.delete(Season(id=2007).country_stats_key)
+        for key in redis_client.scan_iter("token-bucket:*"):
+            redis_client.delete(key)
+
     def test_list(self):
         client = APIClient()
         response = client.get("/api/v1/seasons")
@@ -265,6 +978,238 @@ class SeasonViewSetTestCase(TestCase):
         self.assertEqual(array[1]["text"], "Goodbye Cruel World")
         self.assertFalse(array[1]["is_author"])
 
+    def test_chat_cursor(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        user = User.objects.create(login="exploitable")
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        participation = Participation.objects.create(season=season, user=user)
+        santa.giftee = participation
+        santa.save()
+        start = timezone.now() - timedelta(minutes=10)
+        ids = [Message.objects.create(
+            sender=santa if i % 2 else participation,
+            recipient=participation if i % 2 else santa,
+            text="Message {}".format(i),
+            send_date=start + timedelta(minutes=i),
+        ).id for i in range(5)]
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        def texts(query):
+            response = client.get("/api/v1/seasons/2007/santa_chat" + query)
+            self.assertEqual(response.status_code, 200)
+            return [message["text"] for message in json.loads(response.content)]
+
+        self.assertEqual(texts(""), ["Message {}".format(i) for i in range(5)])
+        self.assertEqual(texts("?after_id={}".format(ids[2])), ["Message 3", "Message 4"])
+        self.assertEqual(texts("?after_id={}".format(ids[4])), [])
+        self.assertEqual(texts("?" + urlencode({"since": (start + timedelta(minutes=3)).isoformat()})), ["Message 4"])
+        self.assertEqual(texts("?after_id={}&limit=1".format(ids[0])), ["Message 1"])
+        self.assertEqual(texts("?limit=2"), ["Message 3", "Message 4"])
+        self.assertEqual(texts("?before_id={}&limit=2".format(ids[3])), ["Message 1", "Message 2"])
+        response = client.get("/api/v1/seasons/2007/santa_chat?limit=0")
+        self.assertEqual(response.status_code, 400)
+        conversations = set(Message.objects.values_list("conversation", flat=True))
+        self.assertEqual(conversations, {"2007:{}:{}".format(santa.id, participation.id)})
+
+    def test_unread(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        user = User.objects.create(login="exploitable")
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        participation = Participation.objects.create(season=season, user=user)
+        santa.giftee = participation
+        santa.save()
+        redis_client.delete(unread_key(santa.id), unread_key(participation.id))
+        client = APIClient()
+        client.force_authenticate(user=user)
+        response = client.get("/api/v1/seasons/2007/unread")
+        self.assertEqual(json.loads(response.content), {"santa_chat": 0, "giftee_chat": 0})
+        client.force_authenticate(user=santa.user)
+        response = client.get("/api/v1/seasons/2007/unread")
+        self.assertEqual(json.loads(response.content), {"santa_chat": 0, "giftee_chat": 0})
+        for text in ["Hello", "World"]:
+            with self.captureOnCommitCallbacks(execute=True):
+                client.post("/api/v1/seasons/2007/giftee_chat", {"text": text})
+        client.force_authenticate(user=user)
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post("/api/v1/seasons/2007/santa_chat", {"text": "Thanks"})
+        with self.assertNumQueries(4): # the season and the participation, within a savepoint
+            response = client.get("/api/v1/seasons/2007/unread")
+        self.assertEqual(json.loads(response.content), {"santa_chat": 2, "giftee_chat": 0})
+        self.assertEqual(get_unread(santa), {"santa_chat": 0, "giftee_chat": 1})
+        message = Message.objects.filter(recipient=participation).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/api/v1/messages/mark_read", {"ids": [message.id]}, format="json")
+        self.assertEqual(json.loads(response.content), {"updated": 1})
+        self.assertEqual(get_unread(participation), {"santa_chat": 1, "giftee_chat": 0})
+        # Drift is fixed by the periodic rebuild.
+        redis_client.hset(unread_key(participation.id), "santa_chat", 10)
+        rebuild_unread_counters()
+        self.assertEqual(get_unread(participation), {"santa_chat": 1, "giftee_chat": 0})
+
+    @override_settings(RATE_LIMITS={"chat": {"participation": (2, 0.5), "ip": (3, 0.001)}})
+    def test_chat_rate_limit(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        santa.giftee = Participation.objects.create(season=season, user=User.objects.create(login="exploitable"))
+        santa.save()
+        client = APIClient()
+        client.force_authenticate(user=santa.user)
+        for _ in range(2):
+            response = client.post("/api/v1/seasons/2007/giftee_chat", {"text": "Spam"})
+            self.assertEqual(response.status_code, 200)
+        for _ in range(5):
+            response = client.post("/api/v1/seasons/2007/giftee_chat", {"text": "Spam"})
+            self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "2")
+        self.assertEqual(Message.objects.count(), 2)
+        # Reading is not limited.
+        response = client.get("/api/v1/seasons/2007/giftee_chat")
+        self.assertEqual(response.status_code, 200)
+        # Neither is the other participant, refused requests don't use up the limit of the IP.
+        client.force_authenticate(user=santa.giftee.user)
+        response = client.post("/api/v1/seasons/2007/santa_chat", {"text": "Stop it"})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(RATE_LIMITS={"chat": {"participation": (10, 1), "ip": (3, 0.001)}})
+    def test_chat_rate_limit_spoofed_ip(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        participations = [
+            Participation.objects.create(season=season, user=User.objects.create(login="spammer{}".format(i)))
+            for i in range(5)
+        ]
+        for santa, giftee in zip(participations, participations[1:]):
+            santa.giftee = giftee
+            santa.save()
+        client = APIClient()
+        statuses = []
+        for i, santa in enumerate(participations[:-1]):
+            client.force_authenticate(user=santa.user)
+            response = client.post(
+                "/api/v1/seasons/2007/giftee_chat",
+                {"text": "Spam"},
+                REMOTE_ADDR="10.0.0.1",
+                HTTP_X_FORWARDED_FOR="192.0.2.{}".format(i),
+            )
+            statuses.append(response.status_code)
+        # A made up X-Forwarded-For doesn't get a fresh limit of the IP.
+        self.assertEqual(statuses, [200, 200, 200, 429])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket("test", 2, 10)
+        redis_client.delete("token-bucket:test:key")
+        self.assertEqual(bucket.take("key"), 0)
+        self.assertEqual(bucket.take("key"), 0)
+        self.assertAlmostEqual(bucket.take("key"), 0.1, delta=0.01)
+        time.sleep(0.1)
+        self.assertEqual(bucket.take("key"), 0)
+        # Tokens are taken from all buckets or from none.
+        other = TokenBucket("other", 1, 10)
+        redis_client.delete("token-bucket:other:key")
+        wait, empty = TokenBucket.take_all([(other, "key"), (bucket, "key")])
+        self.assertEqual(empty, 1)
+        self.assertEqual(TokenBucket.take_all([(other, "key")]), (0, None))
+
+    @override_settings(CHAT_STREAM_TIMEOUT=0.2, CHAT_STREAM_HEARTBEAT=0.1, CHAT_LONG_POLL_TIMEOUT=0.2)
+    def test_chat_stream(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        user = User.objects.create(login="exploitable")
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        participation = Participation.objects.create(season=season, user=user)
+        santa.giftee = participation
+        santa.save()
+        client = APIClient()
+        # Not served under WSGI, it would hold a thread per connection.
+        response = client.get("/api/v1/seasons/2007/chat_stream")
+        self.assertEqual(response.status_code, 501)
+        async_client = AsyncClient()
+
+        async def stream(path, **kwargs):
+            return await async_client.get("/api/v1/seasons/2007/chat_stream" + path, **kwargs)
+
+        response = async_to_sync(stream)("")
+        self.assertEqual(response.status_code, 404)
+        # Messages are published to the channel of the recipient.
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("chat:{}".format(participation.id))
+        client.force_authenticate(user=santa.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/api/v1/seasons/2007/giftee_chat", {"text": "Hello"})
+        self.assertEqual(response.status_code, 200)
+        message = None
+        deadline = time.monotonic() + 1
+        while message is None and time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=0.1)
+        pubsub.close()
+        event = json.loads(message["data"])
+        self.assertEqual(event["chat"], "santa_chat")
+        self.assertEqual(event["message"]["text"], "Hello")
+        self.assertFalse(event["message"]["is_author"])
+        # Missed messages are sent right away.
+        with mock.patch.object(user_logged_in, "send"):
+            async_client.force_login(user)
+        get = async_to_sync(stream)
+        response = get("?poll=1&after_id=0")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([e["message"]["text"] for e in json.loads(response.content)], ["Hello"])
+        response = get("?poll=1&after_id={}".format(event["message"]["id"]))
+        self.assertEqual(json.loads(response.content), [])
+        response = get("", headers={"Last-Event-ID": "0"})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        async def read(response):
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        content = async_to_sync(read)(response).decode()
+        self.assertIn("id: {}\nevent: santa_chat\n".format(event["message"]["id"]), content)
+        self.assertIn(": ping", content)
+
+    def test_chat_streams_share_connection(self):
+        async def run():
+            first = listen(mock.Mock(id=1), None, 0.5, 0.5)
+            second = listen(mock.Mock(id=2), None, 0.5, 0.5)
+            # Subscribes on the first step, which waits for a message.
+            tasks = [asyncio.ensure_future(first.__anext__()), asyncio.ensure_future(second.__anext__())]
+            subscriber = get_subscriber()
+            while len(subscriber.queues) < 2 or not all(e.is_set() for e in subscriber.confirmed.values()):
+                await asyncio.sleep(0.01)
+            pubsub = subscriber.pubsub
+            await subscriber.client.publish("chat:2", json.dumps({"message": {"id": 1}}))
+            results = await asyncio.gather(*tasks)
+            await first.aclose()
+            self.assertIs(subscriber.pubsub, pubsub)
+            self.assertEqual(list(subscriber.queues), ["chat:2"])
+            await second.aclose()
+            self.assertIsNone(subscriber.pubsub)
+            return results
+
+        self.assertEqual(async_to_sync(run)(), [[], [{"message": {"id": 1}}]])
+
     def test_post_giftee_chat(self):
         client = APIClient()
         response = client.post("/api/v1/seasons/2007/giftee_chat")
@@ -696,11 +1641,11 @@ class SeasonViewSetTestCase(TestCase):
             registration_close=timezone.now() + timedelta(hours=1),
         )
         # Trick the code by setting some fake data in the cache...
-        cache.set("profile:exploitable", {
+        cache_habr_profile("exploitable", {
             "karma": 0,
             "has_badge": False,
             "is_readonly": False,
-        }, 5)
+        })
         response = client.post("/api/v1/seasons/2007/participation")
         self.assertEqual(response.status_code, 403)
         self.assertEqual(
@@ -710,11 +1655,11 @@ class SeasonViewSetTestCase(TestCase):
         user = User.objects.create(login="kafeman")
         client.force_authenticate(user=user)
         # Trick the code by setting some fake data in the cache...
-        cache.set("profile:kafeman", {
+        cache_habr_profile("kafeman", {
             "karma": 100,
             "has_badge": True,
             "is_readonly": False,
-        }, 5)
+        })
         response = client.post("/api/v1/seasons/2007/participation")
         self.assertEqual(response.status_code, 400)
         obj = json.loads(response.content)
@@ -850,6 +1795,97 @@ class SeasonViewSetTestCase(TestCase):
         self.assertEqual(response.content, b"{}")
         # TODO: add more tests...
 
+    def test_country_stats(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=1),
+            registration_close=timezone.now() + timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=2),
+            member_count=3,
+        )
+        for login, country in [("kafeman", "RU"), ("negasus", "RU"), ("Boomburum", "UA")]:
+            Participation.objects.create(season=season, user=User.objects.create(login=login), country=country)
+        client = APIClient()
+        response = client.get("/api/v1/seasons/2007/countries")
+        self.assertEqual(json.loads(response.content), {"RU": 2, "UA": 1})
+        self.assertIn("s-maxage", response["Cache-Control"])
+        # Now served from Redis.
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(season.get_country_stats(), {"RU": 2, "UA": 1})
+        self.assertEqual(len(context.captured_queries), 0)
+        client.force_authenticate(user=User.objects.get(login="negasus"))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.delete("/api/v1/seasons/2007/participation")
+        self.assertEqual(response.status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            Participation.objects.create(season=season, user=User.objects.create(login="dm"), country="UA")
+            season.adjust_country_stats("UA", 1)
+        self.assertEqual(list(season.get_country_stats().items()), [("UA", 2), ("RU", 1)])
+        # Drift is fixed by the periodic rebuild.
+        redis_client.hset(season.country_stats_key, "RU", 10)
+        rebuild_country_stats()
+        self.assertEqual(season.get_country_stats(), {"UA": 2, "RU": 1})
+        # A season without participants is cached too.
+        empty = Season.objects.create(
+            id=2008,
+            registration_open=timezone.now() - timedelta(hours=1),
+            registration_close=timezone.now() + timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=2),
+        )
+        redis_client.delete(empty.country_stats_key)
+        self.assertEqual(empty.get_country_stats(), {})
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(empty.get_country_stats(), {})
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_bootstrap(self):
+        client = APIClient()
+        response = client.get("/api/v1/seasons/2007/bootstrap")
+        self.assertEqual(response.status_code, 404)
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(hours=2),
+            registration_close=timezone.now() - timedelta(hours=1),
+            season_close=timezone.now() + timedelta(hours=1),
+        )
+        response = client.get("/api/v1/seasons/2007/bootstrap")
+        self.assertEqual(response.status_code, 200)
+        obj = json.loads(response.content)
+        self.assertFalse(obj["info"]["is_authenticated"])
+        self.assertEqual(obj["season"]["id"], 2007)
+        self.assertIn({ "code": "AL", "name": "Албания" }, obj["countries"])
+        self.assertIsNone(obj["participation"])
+        user = User.objects.create(login="exploitable")
+        client.force_authenticate(user=user)
+        cache_habr_profile("exploitable", {
+            "karma": 2,
+            "has_badge": False,
+            "is_readonly": False,
+            "avatar_url": None,
+        })
+        response = client.get("/api/v1/seasons/2007/bootstrap")
+        self.assertEqual(response.status_code, 200)
+        obj = json.loads(response.content)
+        self.assertTrue(obj["info"]["is_authenticated"])
+        self.assertEqual(obj["info"]["karma"], 2)
+        self.assertIsNone(obj["participation"])
+        participation = Participation.objects.create(season=season, user=user, fullname="Exploitable")
+        giftee = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="negasus"), giftee=participation)
+        participation.giftee = giftee
+        participation.save()
+        Message.objects.create(sender=participation, recipient=giftee, text="Hello Giftee")
+        Message.objects.create(sender=santa, recipient=participation, text="Hello from Santa")
+        Message.objects.create(sender=participation, recipient=santa, text="Hello Santa")
+        response = client.get("/api/v1/seasons/2007/bootstrap")
+        self.assertEqual(response.status_code, 200)
+        obj = json.loads(response.content)
+        self.assertEqual(obj["participation"]["fullname"], "Exploitable")
+        self.assertEqual([m["text"] for m in obj["giftee_chat"]], ["Hello Giftee"])
+        self.assertEqual([m["text"] for m in obj["santa_chat"]], ["Hello from Santa", "Hello Santa"])
+        self.assertFalse(obj["santa_chat"][0]["is_author"])
+        self.assertTrue(obj["santa_chat"][1]["is_author"])
+
     def test_kick_participant(self):
         client = APIClient()
         response = client.delete("/api/v1/seasons/2007/participants/negasus")
@@ -1154,12 +2190,12 @@ class UserViewSetTestCase(TestCase):
         )
         User.objects.filter(login="negasus").update(email_allowed=False)
         # Trick the code by setting some fake data in the cache...
-        cache.set("profile:negasus", {
+        cache_habr_profile("negasus", {
             "karma": 135,
             "has_badge": True,
             "is_readonly": False,
             "avatar_url": "//habrastorage.org/getpro/habr/avatars/74a/1b6/c64/74a1b6c647c673df32177e355647ac71.jpg",
-        }, 5)
+        })
         response = client.post("/api/v1/users/negasus/allow_emails")
         self.assertEqual(response.status_code, 200)
         obj = json.loads(response.content)
@@ -1362,12 +2398,12 @@ class BackendViewTestCase(TestCase):
         user = User.objects.create(login="exploitable")
         client.force_authenticate(user=user)
         # Trick the code by setting some fake data in the cache...
-        cache.set("profile:exploitable", {
+        cache_habr_profile("exploitable", {
             "karma": 2,
             "has_badge": False,
             "is_readonly": False,
             "avatar_url": None,
-        }, 5)
+        })
         response = client.get("/backend/info")
         self.assertEqual(response.status_code, 200)
         obj = json.loads(response.content)
@@ -1398,3 +2434,64 @@ class MessageViewSetTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.content)["updated"], 0)
         # TODO: add more tests...
+
+
+class ChatNotificationsTestCase(TestCase):
+    def test_send_chat_notifications(self):
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            address_match=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+        )
+        participations = [
+            Participation.objects.create(season=season, user=User.objects.create(login="user{}".format(i)))
+            for i in range(10)
+        ]
+        for i, participation in enumerate(participations):
+            for _ in range(i % 3 + 1):
+                Message.objects.create(sender=participations[i - 1], recipient=participation, text="Hi")
+        command = cron.Command(stdout=io.StringIO())
+        with mock.patch("habrasanta.chat.group") as group:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertNumQueries(4): # SAVEPOINT, SELECT, UPDATE, RELEASE
+                    command.send_chat_notifications()
+        tasks = group.call_args.args[0]
+        self.assertEqual(len(tasks), 20)
+        self.assertIn("<b>3</b> новых сообщения", tasks[4].args[1])
+        self.assertFalse(User.objects.filter(last_chat_notification=None).exists())
+        with mock.patch("habrasanta.chat.group") as group:
+            command.send_chat_notifications()
+        group.assert_not_called()
+
+    def test_debounced_chat_notifications(self):
+        redis_client.delete(NOTIFICATIONS_KEY)
+        season = Season.objects.create(
+            id=2007,
+            registration_open=timezone.now() - timedelta(days=2),
+            registration_close=timezone.now() - timedelta(days=1),
+            address_match=timezone.now() - timedelta(days=1),
+            season_close=timezone.now() + timedelta(days=30),
+        )
+        santa = Participation.objects.create(season=season, user=User.objects.create(login="kafeman"))
+        giftee = Participation.objects.create(season=season, user=User.objects.create(login="exploitable"))
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                Message.objects.create(sender=santa, recipient=giftee, text="Hi")
+                schedule_notification(giftee.user_id)
+        # Not due yet.
+        self.assertEqual(send_chat_notifications(), 0)
+        due = redis_client.zscore(NOTIFICATIONS_KEY, giftee.user_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            schedule_notification(giftee.user_id)
+        self.assertEqual(redis_client.zscore(NOTIFICATIONS_KEY, giftee.user_id), due)
+        redis_client.zadd(NOTIFICATIONS_KEY, {giftee.user_id: time.time() - 1})
+        with mock.patch("habrasanta.chat.group") as group:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(send_chat_notifications(), 1)
+        tasks = group.call_args.args[0]
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0].args[0], giftee.user_id)
+        self.assertIn("<b>3</b> новых сообщения", tasks[0].args[1])
+        self.assertEqual(redis_client.zcard(NOTIFICATIONS_KEY), 0)
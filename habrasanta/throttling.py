@@ -0,0 +1,38 @@
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from habrasanta import metrics
+from habrasanta.utils import TokenBucket
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Limits the requests with the token buckets configured by RATE_LIMITS[scope],
+    one per participation (user and season) and one per IP address.
+
+    A request takes a token from both buckets or from neither, so the requests refused
+    for one participation don't use up the limit of everybody behind the same IP.
+    DRF responds with 429 Too Many Requests and Retry-After, if the throttle refuses.
+    """
+    kinds = ["participation", "ip"]
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.buckets = [
+            TokenBucket("{}:{}".format(scope, kind), *settings.RATE_LIMITS[scope][kind])
+            for kind in self.kinds
+        ]
+        self.wait_time = 0
+
+    def allow_request(self, request, view):
+        keys = [
+            "{}:{}".format(request.user.id, view.kwargs.get("pk")),
+            self.get_ident(request),
+        ]
+        self.wait_time, empty = TokenBucket.take_all(list(zip(self.buckets, keys)))
+        if self.wait_time:
+            metrics.incr("throttled_requests_total", scope=self.scope, kind=self.kinds[empty])
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
@@ -19,6 +19,7 @@ urlpatterns = [
     path("", views.IndexView.as_view()),
     path("<int:year>/", views.FrontendView.as_view(), name="welcome"),
     path("<int:year>/profile/", views.FrontendView.as_view(), name="profile"),
+    path("api/v1/seasons/<int:pk>/chat_stream", views.chat_stream, name="chat-stream"),
     path("api/v1/", include(router.urls)),
     path("backend/login", views.LoginView.as_view(), name="login"),
     path("backend/login/callback", views.CallbackView.as_view(), name="callback"),
@@ -26,6 +27,7 @@ urlpatterns = [
     path("backend/info", views.InfoView.as_view(), name="userinfo"),
     path("backend/unsubscribe", views.unsubscribe, name="unsubscribe"),
     path("backend/health", views.HealthView.as_view(), name="health"),
+    path("backend/metrics", views.MetricsView.as_view(), name="metrics"),
     path("django_admin/", admin.site.urls),
     path("api/schema", SpectacularAPIView.as_view(), name="schema"),
     path("api/explorer", SpectacularSwaggerView.as_view(url_name="schema"), name="swagger-ui"),
@@ -1,17 +1,231 @@
 import logging
+import re
+import redis
 import requests
+import threading
 import time
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from django.conf import settings
 from django.core.cache import cache
+from django.db import close_old_connections
 from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 from urllib3.util import Retry
 
+from habrasanta import metrics
+
 
 logger = logging.getLogger(__name__)
 
 
-session = requests.Session()
+redis_client = redis.Redis.from_url(settings.REDIS_URL)
+
+
+def russian_plural(n, one, few, many):
+    if n % 10 == 1 and n % 100 != 11:
+        return one
+    if n % 10 >= 2 and n % 10 <= 4 and (n % 100 < 10 or n % 100 >= 20):
+        return few
+    return many
+
+
+class HabrIsDownException(Exception):
+    def __init__(self):
+        super().__init__("Habr is offline")
+
+
+class HabrUserNotFoundException(Exception):
+    def __init__(self, username):
+        super().__init__("User '{}' does not exist on Habr".format(username))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a service after too many consecutive failures.
+
+    The state is kept in Redis, so all processes see it. Once open, every request fails
+    immediately for reset_timeout seconds. After that, a single probe request is allowed
+    through: if it succeeds, the breaker closes, otherwise it opens again.
+    """
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+    def key(self, suffix):
+        return "circuit-breaker:{}:{}".format(self.name, suffix)
+
+    def before_request(self):
+        """
+        Raises HabrIsDownException if the request must not be sent.
+        Returns the number of consecutive failures so far.
+        """
+        try:
+            is_open, failures = redis_client.mget(self.key("open"), self.key("failures"))
+            failures = int(failures or 0)
+            if not is_open and failures >= self.threshold:
+                # Half-open: only one process may probe the service.
+                is_open = not redis_client.set(self.key("probe"), 1, nx=True, ex=self.reset_timeout)
+        except redis.RedisError as e:
+            logger.warning("Circuit breaker '{}' is unavailable: {}".format(self.name, e))
+            return 0
+        if is_open:
+            metrics.incr("circuit_breaker_rejected_total", breaker=self.name)
+            raise HabrIsDownException()
+        return failures
+
+    def record_success(self, failures):
+        if not failures:
+            return
+        try:
+            redis_client.delete(self.key("failures"), self.key("probe"))
+        except redis.RedisError as e:
+            logger.warning("Circuit breaker '{}' is unavailable: {}".format(self.name, e))
+            return
+        if failures >= self.threshold:
+            logger.warning("Circuit breaker '{}' is closed again".format(self.name))
+            metrics.incr("circuit_breaker_transitions_total", breaker=self.name, state="closed")
+
+    def record_failure(self):
+        try:
+            pipeline = redis_client.pipeline()
+            pipeline.incr(self.key("failures"))
+            pipeline.expire(self.key("failures"), self.reset_timeout * 10)
+            failures, _ = pipeline.execute()
+            if failures < self.threshold:
+                return
+            redis_client.set(self.key("open"), 1, ex=self.reset_timeout)
+            redis_client.delete(self.key("probe"))
+        except redis.RedisError as e:
+            logger.warning("Circuit breaker '{}' is unavailable: {}".format(self.name, e))
+            return
+        logger.warning("Circuit breaker '{}' is open after {} failures".format(self.name, failures))
+        metrics.incr("circuit_breaker_transitions_total", breaker=self.name, state="open")
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to capacity requests, refilled at rate requests per second.
+
+    Each check is a single Redis round trip: the bucket is updated by a Lua script,
+    so concurrent requests never take the same token.
+    """
+    script = redis_client.register_script("""
+        local now = tonumber(ARGV[1])
+        local buckets = {}
+        local wait = 0
+        local empty = 0
+        for i, key in ipairs(KEYS) do
+            local capacity = tonumber(ARGV[i * 2])
+            local rate = tonumber(ARGV[i * 2 + 1])
+            local state = redis.call("HMGET", key, "tokens", "updated")
+            local tokens = tonumber(state[1]) or capacity
+            local updated = tonumber(state[2]) or now
+            tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+            if tokens < 1 and (1 - tokens) / rate > wait then
+                wait = (1 - tokens) / rate
+                empty = i
+            end
+            buckets[i] = {tokens, math.ceil(capacity / rate) + 1}
+        end
+        for i, key in ipairs(KEYS) do
+            local tokens = buckets[i][1]
+            if wait == 0 then
+                tokens = tokens - 1
+            end
+            redis.call("HSET", key, "tokens", tokens, "updated", now)
+            redis.call("EXPIRE", key, buckets[i][2])
+        end
+        return {tostring(wait), empty}
+    """)
+
+    def __init__(self, name, capacity, rate):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+
+    def take(self, key):
+        """
+        Takes a token for the given key and returns 0, or the number of seconds to wait for it.
+        """
+        wait, _ = TokenBucket.take_all([(self, key)])
+        return wait
+
+    @classmethod
+    def take_all(cls, buckets):
+        """
+        Takes a token from each of the given (bucket, key) pairs, or from none of them if any is empty.
+
+        Returns 0 and None, or the number of seconds to wait and the index of the pair to wait for.
+        """
+        try:
+            wait, empty = cls.script(
+                keys=["token-bucket:{}:{}".format(bucket.name, key) for bucket, key in buckets],
+                args=[time.time()] + [value for bucket, _ in buckets for value in (bucket.capacity, bucket.rate)],
+            )
+        except redis.RedisError as e:
+            # Better let a spammer through than block everybody.
+            logger.warning("Token buckets {} are unavailable: {}".format(
+                ", ".join("'{}'".format(bucket.name) for bucket, _ in buckets), e))
+            return 0, None
+        return float(wait), (empty - 1 if empty else None)
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def endpoint_template(url):
+    """
+    Turns https://habr.com/api/v2/users/kafeman/card into /users/{}/card.
+    """
+    path = urlparse(url).path
+    if path.startswith("/api/v2/"):
+        path = path[len("/api/v2"):]
+    return re.sub(r"^/users/[^/]+", "/users/{}", path)
+
+
+class HabrSession(requests.Session):
+    """
+    Fails fast with HabrIsDownException while Habr is known to be down
+    and records the latency and outcome of every request.
+    """
+    def __init__(self, breaker):
+        super().__init__()
+        self.breaker = breaker
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_template(url)
+        failures = self.breaker.before_request()
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.record(method, endpoint, start, type(e).__name__)
+            self.breaker.record_failure()
+            raise
+        self.record(method, endpoint, start, response.status_code)
+        retries = getattr(response.raw, "retries", None)
+        if isinstance(retries, Retry) and retries.history:
+            metrics.incr("habr_request_retries_total", len(retries.history), method=method, endpoint=endpoint)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success(failures)
+        return response
+
+    def record(self, method, endpoint, start, status):
+        metrics.observe("habr_request_duration_seconds", time.monotonic() - start, LATENCY_BUCKETS,
+            method=method, endpoint=endpoint)
+        metrics.incr("habr_requests_total", method=method, endpoint=endpoint, status=status)
+
+
+session = HabrSession(CircuitBreaker(
+    "habr",
+    threshold=settings.HABR_BREAKER_THRESHOLD,
+    reset_timeout=settings.HABR_BREAKER_RESET_TIMEOUT,
+))
 session.headers.update({
     "User-Agent": settings.HABR_USER_AGENT,
 })
@@ -21,56 +235,335 @@ retries = Retry(
     backoff_factor=0.1,
     allowed_methods=["GET"],
 )
-session.mount("https://habr.com/", HTTPAdapter(max_retries=retries))
+# Keep as many connections as there are uwsgi threads.
+session.mount("https://habr.com/", HTTPAdapter(max_retries=retries, pool_maxsize=20))
 
 
-class HabrIsDownException(Exception):
-    def __init__(self):
-        super().__init__("Habr is offline")
+class LocalCache:
+    """
+    A tiny thread-safe LRU cache living in the memory of the current process.
+    """
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def hincrby_if_exists(key, field, delta):
+    """
+    Changes a counter in a Redis hash, unless the hash is missing and must be rebuilt from scratch.
+    """
+    def incr(pipeline):
+        if pipeline.exists(key):
+            pipeline.multi()
+            pipeline.hincrby(key, field, delta)
+
+    redis_client.transaction(incr, key)
+
+
+local_profiles = LocalCache(settings.HABR_PROFILE_LOCAL_SIZE, settings.HABR_PROFILE_LOCAL_TTL)
+
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="habr-refresh")
+
+prefetch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="habr-prefetch")
+
+# Profiles being fetched by this process right now, by username.
+inflight_profiles = {}
+inflight_lock = threading.Lock()
 
 
 def fetch_habr_profile(username):
-    profile = cache.get("profile:" + username)
-    if not profile:
-        start = time.time()
-        response = session.get("https://habr.com/api/v2/users/{}/card".format(username), headers={
-            "apikey": settings.HABR_APIKEY,
-        }, timeout=(0.5, 1.0))
-        if response.status_code == 404:
-            # Boomburum is changing usernames again.
-            from habrasanta.models import User
-            from habrasanta.celery import send_notification
-            boomburum = User.objects.get(login="Boomburum")
-            send_notification.delay(
-                boomburum.id,
-                "Пользователя '{}' больше нет с нами.".format(user.login)
-            )
-            return None
-        if response.status_code == 502:
-            raise HabrIsDownException()
-        if response.status_code != 200:
-            logger.warning("Request to {} failed: got status code {}".format(response.url, response.status_code))
-            logger.warning(response.text)
-            return None
-        card = response.json()
-        response = session.get("https://habr.com/api/v2/users/{}/whois".format(username), headers={
-            "apikey": settings.HABR_APIKEY,
-        }, timeout=(0.5, 1.0))
-        if response.status_code == 502:
+    """
+    Returns the Habr profile of the given user.
+
+    Profiles are cached in the memory of the current process for a few seconds and in Redis
+    for longer. When a profile in Redis is older than HABR_PROFILE_TTL, it is still returned
+    during HABR_PROFILE_STALE_TTL, while a single background refresh fetches the new one.
+    """
+    entry = local_profiles.get(username)
+    if entry:
+        metrics.incr("habr_profile_cache_total", result="local_hit")
+        return profile_of(entry)
+    entry = cache.get("profile:" + username)
+    if entry:
+        return use_cached_profile(username, entry)
+    metrics.incr("habr_profile_cache_total", result="miss")
+    return refresh_habr_profile(username)
+
+
+def prefetch_habr_profiles(users):
+    """
+    Loads the Habr profiles of many users at once, e.g. before serializing a page of users.
+
+    Cached profiles are read from Redis with a single request, the missing ones are fetched
+    concurrently, the snapshots are saved with a single query. Accessing User.profile
+    afterwards doesn't make any requests.
+    """
+    from habrasanta.models import User
+    pending = {}
+    for user in users:
+        if hasattr(user, "_profile"):
+            continue
+        snapshot = user.get_profile_snapshot(settings.HABR_PROFILE_SNAPSHOT_MAX_AGE)
+        if snapshot:
+            user._profile = snapshot
+            continue
+        entry = local_profiles.get(user.login)
+        if entry:
+            metrics.incr("habr_profile_cache_total", result="local_hit")
+            if entry.get("missing") != "error":
+                user._profile = entry["profile"]
+            # Otherwise, User.profile falls back to the snapshot.
+        else:
+            pending.setdefault(user.login, []).append(user)
+    if not pending:
+        return
+    entries = cache.get_many(["profile:" + username for username in pending])
+    futures = {}
+    changed = {}
+    for username, users in pending.items():
+        entry = entries.get("profile:" + username)
+        if entry:
+            try:
+                profile = use_cached_profile(username, entry)
+            except HabrIsDownException:
+                continue # User.profile falls back to the snapshot.
+            for user in users:
+                if user.apply_profile(profile):
+                    changed[user.pk] = user
+        else:
+            metrics.incr("habr_profile_cache_total", result="miss")
+            futures[username] = prefetch_executor.submit(prefetch_habr_profile, username)
+    for username, future in futures.items():
+        try:
+            profile = future.result()
+        except Exception as e:
+            # Accessing User.profile will try again and fail the usual way.
+            logger.warning("Could not prefetch the profile of '{}': {}".format(username, e))
+            continue
+        for user in pending[username]:
+            if user.apply_profile(profile):
+                changed[user.pk] = user
+    if changed:
+        User.objects.bulk_update(changed.values(), User.PROFILE_SNAPSHOT_FIELDS)
+
+
+def prefetch_habr_profile(username):
+    try:
+        return refresh_habr_profile(username)
+    finally:
+        close_old_connections()
+
+
+def use_cached_profile(username, entry):
+    local_profiles.set(username, entry)
+    if entry["profile"] is None:
+        metrics.incr("habr_profile_cache_total", result="negative_hit")
+    elif time.time() - entry["fetched_at"] < settings.HABR_PROFILE_TTL:
+        metrics.incr("habr_profile_cache_total", result="hit")
+    else:
+        metrics.incr("habr_profile_cache_total", result="stale")
+        schedule_profile_refresh(username)
+    return profile_of(entry)
+
+
+def profile_of(entry):
+    """
+    Returns the profile of a cache entry, None if the user doesn't exist.
+
+    Raises HabrIsDownException if fetching the profile has failed recently, so the callers
+    can use a snapshot instead of taking the failure for a missing user.
+    """
+    if entry.get("missing") == "error":
+        raise HabrIsDownException()
+    return entry["profile"]
+
+
+def cache_habr_profile(username, profile):
+    entry = {
+        "profile": profile,
+        "fetched_at": time.time(),
+    }
+    cache.set("profile:" + username, entry, settings.HABR_PROFILE_TTL + settings.HABR_PROFILE_STALE_TTL)
+    local_profiles.set(username, entry)
+
+
+def cache_missing_habr_profile(username, reason, timeout):
+    """
+    Remembers for a while that the profile could not be fetched, so Habr isn't asked again.
+    """
+    entry = {
+        "profile": None,
+        "fetched_at": time.time(),
+        "missing": reason,
+    }
+    if reason == "not_found":
+        cache.set("profile:" + username, entry, timeout)
+    elif not cache.add("profile:" + username, entry, timeout):
+        # Keep serving the stale profile instead.
+        return
+    local_profiles.set(username, entry)
+
+
+def notify_user_not_found(username):
+    # Boomburum is changing usernames again.
+    if not cache.add("user-not-found:" + username, True, 60 * 60 * 24):
+        return # Already notified today.
+    from habrasanta.models import User
+    from habrasanta.celery import send_notification
+    boomburum = User.objects.get(login="Boomburum")
+    send_notification.delay(
+        boomburum.id,
+        "Пользователя '{}' больше нет с нами.".format(username)
+    )
+
+
+def refresh_habr_profile(username):
+    """
+    Fetches the profile from Habr and puts it into the cache.
+
+    Concurrent calls for the same username share a single request to Habr: threads of the
+    same process wait for the same future, other processes wait for the Redis lock.
+    """
+    with inflight_lock:
+        future = inflight_profiles.get(username)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            inflight_profiles[username] = future
+    if not is_leader:
+        metrics.incr("habr_profile_singleflight_total", result="shared")
+        return future.result()
+    try:
+        profile = refresh_habr_profile_once(username)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(profile)
+        return profile
+    finally:
+        with inflight_lock:
+            del inflight_profiles[username]
+
+
+def refresh_habr_profile_once(username):
+    lock = "profile-lock:" + username
+    acquired = cache.add(lock, True, settings.HABR_PROFILE_LOCK_TIMEOUT * 2)
+    if not acquired:
+        # Another process is already fetching this profile, wait for it.
+        metrics.incr("habr_profile_singleflight_total", result="waited")
+        deadline = time.monotonic() + settings.HABR_PROFILE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = cache.get("profile:" + username)
+            if entry:
+                return profile_of(entry)
+            if not cache.get(lock):
+                break # The other process has failed, try ourselves.
+        acquired = cache.add(lock, True, settings.HABR_PROFILE_LOCK_TIMEOUT * 2)
+    try:
+        profile = request_habr_profile(username)
+    except HabrUserNotFoundException:
+        cache_missing_habr_profile(username, "not_found", settings.HABR_PROFILE_NOT_FOUND_TTL)
+        notify_user_not_found(username)
+        return None
+    else:
+        if not profile:
+            cache_missing_habr_profile(username, "error", settings.HABR_PROFILE_ERROR_TTL)
             raise HabrIsDownException()
-        if response.status_code != 200:
-            logger.warning("Request to {} failed: got status code {}".format(response.url, response.status_code))
-            logger.warning(response.text)
-            return None
-        whois = response.json()
-        end = time.time()
-        print("Fetched Habr user '{}' in {:.3f} ms.".format(username, (end - start) * 1000))
-        profile = {
-            "login": card["alias"],
-            "avatar_url": card["avatarUrl"],
-            "karma": card["scoreStats"]["score"],
-            "has_badge": len([x for x in whois["badgets"] if x["title"] == "Дед Мороз"]) > 0,
-            "is_readonly": card["isReadonly"],
-        }
-        cache.set("profile:" + username, profile, 60)
-    return profile
+        cache_habr_profile(username, profile)
+        return profile
+    finally:
+        if acquired:
+            cache.delete(lock)
+
+
+def schedule_profile_refresh(username):
+    # Only one process refreshes the profile, the others keep returning the stale one.
+    if not cache.add("profile-refresh:" + username, True, 30):
+        return
+    refresh_executor.submit(background_profile_refresh, username)
+
+
+def background_profile_refresh(username):
+    profile = None
+    try:
+        profile = refresh_habr_profile(username)
+    except HabrIsDownException:
+        logger.warning("Could not refresh the profile of '{}': Habr is failing".format(username))
+    except Exception:
+        logger.exception("Could not refresh the profile of '{}'".format(username))
+    finally:
+        if profile:
+            cache.delete("profile-refresh:" + username)
+        # Otherwise, try again only when the lock expires.
+        close_old_connections()
+    metrics.incr("habr_profile_refresh_total", result="success" if profile else "failure")
+
+
+def habr_api_get(url):
+    return session.get(url, headers={
+        "apikey": settings.HABR_APIKEY,
+    }, timeout=(0.5, 1.0))
+
+
+def request_habr_profile(username):
+    start = time.monotonic()
+    response = habr_api_get("https://habr.com/api/v2/users/{}/card".format(username))
+    if response.status_code == 404:
+        raise HabrUserNotFoundException(username)
+    if response.status_code == 502:
+        raise HabrIsDownException()
+    if response.status_code != 200:
+        logger.warning("Request to {} failed: got status code {}".format(response.url, response.status_code))
+        logger.warning(response.text)
+        return None
+    card = response.json()
+    # Only asked for existing users, so missing and failing ones cost a single request.
+    response = habr_api_get("https://habr.com/api/v2/users/{}/whois".format(username))
+    if response.status_code == 502:
+        raise HabrIsDownException()
+    if response.status_code != 200:
+        logger.warning("Request to {} failed: got status code {}".format(response.url, response.status_code))
+        logger.warning(response.text)
+        return None
+    whois = response.json()
+    elapsed = time.monotonic() - start
+    metrics.observe("habr_profile_fetch_seconds", elapsed, LATENCY_BUCKETS)
+    logger.debug("Fetched Habr user '{}' in {:.3f} ms.".format(username, elapsed * 1000))
+    return {
+        "login": card["alias"],
+        "avatar_url": card["avatarUrl"],
+        "karma": card["scoreStats"]["score"],
+        "has_badge": len([x for x in whois["badgets"] if x["title"] == "Дед Мороз"]) > 0,
+        "is_readonly": card["isReadonly"],
+    }
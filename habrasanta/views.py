@@ -1,20 +1,33 @@
-import datetime
+import hashlib
 import html
 import json
+import time
 import requests
 
+from asgiref.sync import sync_to_async
+from collections import Counter
 from django_countries import countries
 from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.db.models import Count, F, Q
-from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.middleware.csrf import get_token
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
 from django.utils.http import url_has_allowed_host_and_scheme, urlencode
 from django.views import View
@@ -29,10 +42,22 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from urllib.parse import urlparse
 
+from habrasanta import metrics
+from habrasanta.chat import (
+    READ_DATE_INTRODUCED,
+    adjust_unread,
+    format_event,
+    get_unread,
+    listen,
+    publish_message,
+    recipient_chat,
+    schedule_notification,
+)
 from habrasanta.celery import send_email, send_notification, give_badge
 from habrasanta.serializers import (
     AsyncResultSerializer,
     BanRecordSerializer,
+    ChatQuerySerializer,
     EventSerializer,
     MessageBulkSerializer,
     MessageSerializer,
@@ -45,7 +70,8 @@ from habrasanta.serializers import (
     MarkShippedSerializer,
     MarkDeliveredSerializer,
 )
-from habrasanta.utils import fetch_habr_profile, HabrIsDownException
+from habrasanta.throttling import TokenBucketThrottle
+from habrasanta.utils import fetch_habr_profile, prefetch_habr_profiles, HabrIsDownException, LocalCache
 from habrasanta.models import Event, Message, Participation, Season, User
 
 
@@ -59,12 +85,26 @@ class GenericAPIError(APIException):
 class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = SeasonSerializer
     queryset = Season.objects.all()
+    throttle_scopes = {
+        "create_participation": "participation",
+        "cancel_participation": "participation",
+        "mark_shipped": "participation",
+        "mark_delivered": "participation",
+        "post_giftee_chat": "chat",
+        "post_santa_chat": "chat",
+    }
 
     def get_permissions(self):
         if self.action == "create":
             return [IsAdminUser()]
         return super().get_permissions()
 
+    def get_throttles(self):
+        scope = self.throttle_scopes.get(self.action)
+        if scope:
+            return [TokenBucketThrottle(scope)]
+        return super().get_throttles()
+
     def create(self, request):
         """
         Creates a new season.
@@ -88,7 +128,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         Returns the latest season or 404 if there are no seasons yet.
         """
         try:
-            season = Season.objects.latest()
+            season = Season.objects.get_cached()
         except Season.DoesNotExist:
             raise NotFound()
         serializer = self.get_serializer(season)
@@ -130,9 +170,9 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
             raise GenericAPIError("Вы уже зарегистрированы на этот сезон", "dual_participation")
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(season=season, user=request.user)
-        season.member_count += 1
-        season.save()
+        participation = serializer.save(season=season, user=request.user)
+        season.update_counters(member_count=1)
+        season.adjust_country_stats(participation.country, 1)
         Event.objects.create(
             typ=Event.ENROLLED,
             sub=request.user,
@@ -159,8 +199,8 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         if not season.is_registration_open:
             raise GenericAPIError("Нельзя отказаться после окончания регистрации", "the_die_is_cast")
         participation.delete()
-        season.member_count -= 1
-        season.save()
+        season.update_counters(member_count=-1)
+        season.adjust_country_stats(participation.country, -1)
         Event.objects.create(
             typ=Event.UNENROLLED,
             sub=request.user,
@@ -190,6 +230,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         season = self.get_object()
         user = get_object_or_404(User, login__iexact=login)
         participation = get_object_or_404(Participation, user=user, season=season)
+        season.adjust_country_stats(participation.country, -1)
         if season.is_registration_open:
             # Easy peasy :-)
             participation.delete()
@@ -243,8 +284,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
             "Для выяснения подробностей свяжитесь с пользователем @clubadm на Хабре - возможно, ещё не всё потеряно!"
         ).delay)
         # Update counters.
-        season.member_count -= 1
-        season.save()
+        season.update_counters(member_count=-1)
         # Log the event.
         Event.objects.create(
             typ=Event.UNENROLLED,
@@ -279,8 +319,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
             raise NotFound("Вам еще не назначен получателя подарка")
         if participation.gift_shipped_at:
             raise GenericAPIError("Вами уже был отправлен один подарок", "already_shipped")
-        season.shipped_count += 1
-        season.save()
+        season.update_counters(shipped_count=1)
         participation.gift_shipped_at = timezone.now()
         participation.save()
         Event.objects.create(
@@ -335,8 +374,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
             raise GenericAPIError("Вами уже был получен один подарок", "already_delivered")
         if not participation.santa.gift_shipped_at:
             raise GenericAPIError("Нельзя получить подарок до того, как он был отправлен", "not_shipped")
-        season.delivered_count += 1
-        season.save()
+        season.update_counters(delivered_count=1)
         participation.gift_delivered_at = timezone.now()
         participation.save()
         Event.objects.create(
@@ -371,7 +409,10 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
     @method_decorator(cache_control(private=True))
     def giftee_chat(self, request, pk):
         """
-        Returns all chat messages between the current user and their giftee in the given season.
+        Returns chat messages between the current user and their giftee in the given season.
+
+        Pass after_id or since to get only the new messages, before_id and limit to page
+        through the older ones (the latest messages are returned if only limit is given).
 
         An error occurs if:
         - The user is not participating in this season.
@@ -381,13 +422,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         participation = self.get_participation(season)
         if not participation.giftee:
             raise NotFound("Вам еще не назначен получателя подарка")
-        # TODO: select_related() ? Check the SQL queries!
-        messages = Message.objects.filter(
-            Q(sender=participation, recipient=participation.giftee) |
-            Q(sender=participation.giftee, recipient=participation)
-        )
-        serializer = self.get_serializer(messages, many=True, context={ "me": participation })
-        return Response(serializer.data)
+        return Response(self.get_chat(participation, participation.giftee))
 
     @giftee_chat.mapping.post
     def post_giftee_chat(self, request, pk):
@@ -403,17 +438,18 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         participation = self.get_participation(season)
         if not participation.giftee:
             raise NotFound("Вам еще не назначен получателя подарка")
-        # TODO: prevent spamming with too many messages
         serializer = self.get_serializer(data=request.data, context={ "me": participation })
         serializer.is_valid(raise_exception=True)
-        serializer.save(sender=participation, recipient=participation.giftee)
+        message = serializer.save(sender=participation, recipient=participation.giftee)
+        publish_message(message)
+        adjust_unread(message.recipient_id, recipient_chat(message), 1)
+        schedule_notification(message.recipient.user_id)
         Event.objects.create(
             typ=Event.GIFTEE_MAILED,
             sub=request.user,
             season=season,
             ip_address=request.META["REMOTE_ADDR"],
         )
-        # Notification will be send by cron.
         return Response(serializer.data)
 
     @action(
@@ -424,7 +460,10 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
     @method_decorator(cache_control(private=True))
     def santa_chat(self, request, pk):
         """
-        Returns all chat messages between the current user and their santa in the given season.
+        Returns chat messages between the current user and their santa in the given season.
+
+        Pass after_id or since to get only the new messages, before_id and limit to page
+        through the older ones (the latest messages are returned if only limit is given).
 
         An error occurs if:
         - The user is not participating in this season.
@@ -434,13 +473,7 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         participation = self.get_participation(season)
         if not hasattr(participation, "santa"):
             raise NotFound("Вам еще не назначен Дед Мороз")
-        # TODO: select_related() ? Check the SQL queries!
-        messages = Message.objects.filter(
-            Q(sender=participation, recipient=participation.santa) |
-            Q(sender=participation.santa, recipient=participation)
-        )
-        serializer = self.get_serializer(messages, many=True, context={ "me": participation })
-        return Response(serializer.data)
+        return Response(self.get_chat(participation, participation.santa))
 
     @santa_chat.mapping.post
     def post_santa_chat(self, request, pk):
@@ -456,19 +489,69 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         participation = self.get_participation(season)
         if not hasattr(participation, "santa"):
             raise NotFound("Вам еще не назначен Дед Мороз")
-        # TODO: prevent spamming with too many messages
         serializer = self.get_serializer(data=request.data, context={ "me": participation })
         serializer.is_valid(raise_exception=True)
-        serializer.save(sender=participation, recipient=participation.santa)
+        message = serializer.save(sender=participation, recipient=participation.santa)
+        publish_message(message)
+        adjust_unread(message.recipient_id, recipient_chat(message), 1)
+        schedule_notification(message.recipient.user_id)
         Event.objects.create(
             typ=Event.SANTA_MAILED,
             sub=request.user,
             season=season,
             ip_address=request.META["REMOTE_ADDR"],
         )
-        # Notification will be send by cron.
         return Response(serializer.data)
 
+    @action(detail=True)
+    @method_decorator(cache_control(private=True))
+    def bootstrap(self, request, pk):
+        """
+        Returns everything the profile page needs in a single response:
+        the current user (as /backend/info does), the season, the list of countries,
+        the participation of the current user and both chats.
+
+        Fails the same way /backend/info does, if Habr is not available.
+        """
+        season = self.get_object()
+        try:
+            info = get_user_info(request)
+        except requests.exceptions.Timeout as e:
+            return Response({ "error": str(e) }, status=504)
+        except HabrIsDownException as e:
+            return Response({ "error": str(e) }, status=500)
+        data = {
+            "info": info,
+            "season": SeasonSerializer(season).data,
+            "countries": get_countries(),
+            "participation": None,
+            "santa_chat": [],
+            "giftee_chat": [],
+        }
+        if not request.user.is_authenticated:
+            return Response(data)
+        participation = Participation.objects.select_related("santa", "giftee").filter(
+            user=request.user,
+            season=season,
+        ).first()
+        if not participation:
+            return Response(data)
+        data["participation"] = ParticipationSerializer(participation).data
+        santa = getattr(participation, "santa", None)
+        if santa or participation.giftee:
+            # Both chats at once.
+            messages = Message.objects.filter(conversation__in=[
+                Message.conversation_key(participation, other) for other in [santa, participation.giftee] if other
+            ])
+            context = { "me": participation }
+            for chat, other in [("santa_chat", santa), ("giftee_chat", participation.giftee)]:
+                if other:
+                    data[chat] = MessageSerializer([
+                        message for message in messages
+                        if other.id in (message.sender_id, message.recipient_id)
+                    ], many=True, context=context).data
+        return Response(data)
+
     @action(
         detail=True,
         serializer_class=EventSerializer,
@@ -487,21 +570,17 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
         return Response(serializer.data)
 
     @action(detail=True)
-    @method_decorator(cache_control(public=True))
+    @method_decorator(cache_control(
+        public=True,
+        max_age=settings.COUNTRY_STATS_MAX_AGE,
+        s_maxage=settings.COUNTRY_STATS_MAX_AGE,
+    ))
     def countries(self, request, pk):
         """
         Shows country statistics for the given season.
         """
         season = self.get_object()
-        stats = Participation.objects.filter(
-            season=season,
-        ).values("country").annotate(
-            count=Count("id"),
-        ).order_by("-count", "country")
-        result = {}
-        for item in stats:
-            result[item["country"]] = item["count"]
-        return Response(result)
+        return Response(season.get_country_stats())
 
     @action(
         detail=True,
@@ -535,6 +614,41 @@ class SeasonViewSet(viewsets.ReadOnlyModelViewSet):
             gift_shipped_at__isnull=True,
         ).values_list("user__login", flat=True))
 
+    @action(
+        detail=True,
+        permission_classes=[IsAuthenticated],
+    )
+    @method_decorator(cache_control(private=True))
+    def unread(self, request, pk):
+        """
+        Returns the number of unread messages in both chats of the current user in the given season.
+
+        An error occurs if the user is not participating in this season.
+        """
+        season = self.get_object()
+        participation = self.get_participation(season)
+        return Response(get_unread(participation))
+
+    def get_chat(self, participation, other):
+        serializer = ChatQuerySerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        # A single range of the (conversation, send_date) index.
+        messages = Message.objects.filter(conversation=Message.conversation_key(participation, other))
+        if "after_id" in params:
+            messages = messages.filter(id__gt=params["after_id"])
+        if "since" in params:
+            messages = messages.filter(send_date__gt=params["since"])
+        if "before_id" in params:
+            messages = messages.filter(id__lt=params["before_id"])
+        if "limit" in params:
+            if "after_id" in params or "since" in params:
+                messages = messages.order_by("send_date", "id")[:params["limit"]]
+            else:
+                # The latest messages, still in chronological order.
+                messages = reversed(messages.order_by("-send_date", "-id")[:params["limit"]])
+        return MessageSerializer(list(messages), many=True, context={ "me": participation }).data
+
     def check_season_active(self, season):
         if season.is_closed:
             raise GenericAPIError("Этот сезон находится в архиве", "season_archived")
@@ -565,13 +679,18 @@ class MessageViewSet(viewsets.GenericViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         ids = serializer.validated_data["ids"]
-        count = Message.objects.filter(
+        messages = list(Message.objects.select_for_update(of=("self",)).filter(
             id__in=ids,
             recipient__user=request.user,
             read_date__isnull=True,
             # read_date was introduced on this day, all messages before must stay NULL.
-            send_date__gte=timezone.make_aware(datetime.datetime(2016, 12, 20))
-        ).update(read_date=timezone.now())
+            send_date__gte=READ_DATE_INTRODUCED,
+        ).select_related("sender").only("id", "recipient_id", "sender__giftee_id"))
+        count = Message.objects.filter(id__in=[message.id for message in messages]).update(read_date=timezone.now())
+        for (recipient_id, chat), read in Counter(
+            (message.recipient_id, recipient_chat(message)) for message in messages
+        ).items():
+            adjust_unread(recipient_id, chat, -read)
         return Response({ "updated": count })
 
 
@@ -582,6 +701,13 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     lookup_field = "login__iexact"
     lookup_url_kwarg = "login"
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            # UserSerializer needs the Habr profile of each user on the page.
+            prefetch_habr_profiles(page)
+        return page
+
     @action(
         detail=True,
         methods=["post"],
@@ -778,8 +904,7 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
             raise GenericAPIError("Этот пользователь уже отправил подарок", "already_shipped")
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        participation.season.shipped_count += 1
-        participation.season.save()
+        participation.season.update_counters(shipped_count=1)
         participation.gift_shipped_at = serializer.validated_data["gift_shipped_at"]
         participation.save()
         Event.objects.create(
@@ -839,8 +964,7 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
             raise GenericAPIError("Нельзя получить подарок до того, как он был отправлен", "not_shipped")
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        participation.season.delivered_count += 1
-        participation.season.save()
+        participation.season.update_counters(delivered_count=1)
         participation.gift_delivered_at = serializer.validated_data["gift_delivered_at"]
         participation.save()
         Event.objects.create(
@@ -893,34 +1017,46 @@ class CountryViewSet(viewsets.ViewSet):
         """
         Lists all accepted countries.
         """
-        return Response(sorted([{
-            "code": code,
-            "name": name,
-        } for code, name in countries], key=lambda c: c["name"]))
+        return Response(get_countries())
+
+
+def get_countries():
+    return sorted([{
+        "code": code,
+        "name": name,
+    } for code, name in countries], key=lambda c: c["name"])
+
+
+def get_user_info(request):
+    """
+    Describes the current user. Raises exceptions if the Habr profile can't be fetched.
+    """
+    data = {
+        "csrf_token": get_token(request),
+        "is_authenticated": request.user.is_authenticated,
+        "is_active": False,
+        "can_participate": False,
+        "is_debug": settings.DEBUG,
+    }
+    if request.user.is_authenticated:
+        data["username"] = request.user.login
+        data["avatar_url"] = request.user.avatar_url
+        data["karma"] = request.user.karma
+        data["is_readonly"] = request.user.is_readonly
+        data["has_badge"] = request.user.has_badge
+        data["is_active"] = not request.user.is_banned
+        data["can_participate"] = request.user.can_participate
+    return data
 
 
 class InfoView(APIView):
     def get(self, request, format=None):
-        data = {
-            "csrf_token": get_token(request),
-            "is_authenticated": request.user.is_authenticated,
-            "is_active": False,
-            "can_participate": False,
-            "is_debug": settings.DEBUG,
-        }
-        if request.user.is_authenticated:
-            try:
-                data["username"] = request.user.login
-                data["avatar_url"] = request.user.avatar_url
-                data["karma"] = request.user.karma
-                data["is_readonly"] = request.user.is_readonly
-                data["has_badge"] = request.user.has_badge
-                data["is_active"] = not request.user.is_banned
-                data["can_participate"] = request.user.can_participate
-            except requests.exceptions.Timeout as e:
-                return Response({ "error": str(e) }, status=504)
-            except HabrIsDownException as e:
-                return Response({ "error": str(e) }, status=500)
+        try:
+            data = get_user_info(request)
+        except requests.exceptions.Timeout as e:
+            return Response({ "error": str(e) }, status=504)
+        except HabrIsDownException as e:
+            return Response({ "error": str(e) }, status=500)
         return Response(data)
 
 
@@ -992,7 +1128,7 @@ class FakeAuthorizeView(View):
 class IndexView(View):
     def get(self, request):
         try:
-            season = Season.objects.latest()
+            season = Season.objects.get_cached()
         except Season.DoesNotExist:
             raise Http404("No seasons")
         if request.user.is_authenticated:
@@ -1000,12 +1136,100 @@ class IndexView(View):
         return redirect("welcome", year=season.id)
 
 
+# Changes with every frontend deploy, so that new bundles are picked up immediately.
+WEBPACK_VERSION = hashlib.sha1(json.dumps(settings.WEBPACK, sort_keys=True).encode()).hexdigest()[:12]
+
+
+@method_decorator(cache_control(no_cache=True), name="dispatch")
 class FrontendView(View):
+    """
+    The HTML shell of the SPA.
+
+    It is the same for all users (the CSRF token is obtained from /backend/info), so
+    the rendered page is cached until the season or its counters change.
+    """
+    local_cache = LocalCache(32, 60)
+
     def get(self, request, year):
-        season = get_object_or_404(Season, id=year)
-        return render(request, "habrasanta/frontend.html", {
+        key = "frontend:{}:{}:{}".format(Season.objects.cache_version(), year, WEBPACK_VERSION)
+        page = self.local_cache.get(key) or cache.get(key)
+        if not page or page["expires"] < time.time():
+            page = self.render_page(year)
+            cache.set(key, page, page["expires"] - time.time())
+        self.local_cache.set(key, page)
+        response = HttpResponse(page["html"])
+        response["ETag"] = page["etag"]
+        return get_conditional_response(request, etag=page["etag"], response=response)
+
+    def render_page(self, year):
+        try:
+            season = Season.objects.get_cached(year)
+        except Season.DoesNotExist:
+            raise Http404("No such season")
+        content = render_to_string("habrasanta/frontend.html", {
             "season": SeasonSerializer(season).data,
         })
+        # is_registration_open and is_closed are computed from the current time,
+        # so the page must not outlive the next deadline of the season.
+        now = timezone.now()
+        expires = time.time() + min([settings.FRONTEND_CACHE_TTL] + [
+            (deadline - now).total_seconds() for deadline in (
+                season.registration_open,
+                season.registration_close,
+                season.season_close,
+            ) if deadline > now
+        ])
+        return {
+            "html": content,
+            "etag": '"{}"'.format(hashlib.sha1(content.encode()).hexdigest()),
+            "expires": expires,
+        }
+
+
+def get_stream_participation(request, pk):
+    if not request.user.is_authenticated:
+        return None
+    return Participation.objects.select_related("santa", "giftee").filter(user=request.user, season_id=pk).first()
+
+
+@transaction.non_atomic_requests
+async def chat_stream(request, pk):
+    """
+    Streams the messages received by the current user in the given season as server-sent events.
+
+    Events are named after the chat on the user's side (santa_chat or giftee_chat), their ID is the
+    message ID, so the messages missed while reconnecting are sent first. Clients without
+    EventSource may pass poll=1 to wait for the next messages and get them as a JSON list.
+
+    Must be served by habrasanta.asgi, so that open connections don't hold uwsgi threads.
+    """
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI every open connection would hold a worker thread for minutes.
+        return JsonResponse({ "detail": "Этот адрес обслуживается только через ASGI" }, status=501)
+    participation = await sync_to_async(get_stream_participation)(request, pk)
+    if not participation:
+        return JsonResponse({ "detail": "Ой, а вы во всем этом и не участвуете" }, status=404)
+    after_id = request.headers.get("Last-Event-ID") or request.GET.get("after_id")
+    after_id = int(after_id) if after_id and after_id.isdigit() else None
+    if request.GET.get("poll"):
+        events = []
+        listener = listen(participation, after_id, settings.CHAT_LONG_POLL_TIMEOUT, settings.CHAT_LONG_POLL_TIMEOUT)
+        try:
+            async for events in listener:
+                if events:
+                    break
+        finally:
+            await listener.aclose()
+        response = JsonResponse(events, safe=False)
+    else:
+        async def stream():
+            async for events in listen(participation, after_id, settings.CHAT_STREAM_TIMEOUT, settings.CHAT_STREAM_HEARTBEAT):
+                yield "".join(format_event(event) for event in events) if events else ": ping\n\n"
+        response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+        # Don't let nginx buffer the stream.
+        response["X-Accel-Buffering"] = "no"
+    response["Cache-Control"] = "no-cache, private"
+    return response
 
 
 @csrf_exempt # already validated by email_token
@@ -1046,6 +1270,13 @@ def unsubscribe(request):
     })
 
 
+class MetricsView(View):
+    def get(self, request):
+        if request.META["REMOTE_ADDR"] not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+            raise Http404()
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
 class HealthView(View):
     def get(self, request):
         return HttpResponse("okay", content_type="text/plain")